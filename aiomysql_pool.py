@@ -4,8 +4,12 @@
     async mysql pool
 """
 
+import time
 import asyncio
 from .aiomysql_connection import connect
+from .table_meta import TableMetaCache
+from .batch_common import (RateLimiter, RangeQueue, split_id_range, summarize_workers, worker_report,
+                           is_retryable_error)
 from aiomysql import Pool as MysqlPool
 from aiomysql.utils import _PoolContextManager
 
@@ -21,6 +25,9 @@ async def _create_pool(minsize=1, maxsize=10, echo=False, pool_recycle=-1,
                        loop=None, **kwargs):
     if loop is None:
         loop = asyncio.get_event_loop()
+    # all connections of the pool share one table metadata cache
+    if kwargs.get('meta_cache') is None:
+        kwargs['meta_cache'] = TableMetaCache()
 
     pool = Pool(minsize=minsize, maxsize=maxsize, echo=echo,
                 pool_recycle=pool_recycle, loop=loop, **kwargs)
@@ -30,6 +37,66 @@ async def _create_pool(minsize=1, maxsize=10, echo=False, pool_recycle=-1,
     return pool
 
 
+async def parallel_backfill_history_data(pool, table_name, workers=4, parts=None, chunk_size=1000,
+                                         rows_per_second=None, operate_user=None, sleep=0, max_lag=None,
+                                         lag_checker=None, max_attempts=3):
+    """
+    split the id space of a main table into ranges, backfill and verify them on workers connections of the pool
+    concurrently, one task per connection; a failed range is put back and taken by another task, the committed
+    chunks are skipped, after max_attempts failures it's reported in 'failed'; a task stops at an error other
+    than deadlock or lock wait timeout
+    :param pool: Pool
+    :param table_name: main table
+    :param workers: number of connections, no more than pool.maxsize
+    :param parts: number of id ranges, default is workers * 4
+    :param chunk_size: rows of main table per chunk
+    :param rows_per_second: the rows per second budget of all workers, None means unlimited
+    :param operate_user:
+    :param sleep: seconds every task sleeps between chunks
+    :param max_lag: wait while the replication lag is more than so many seconds, requires lag_checker
+    :param lag_checker: function (or coroutine function) returns the replication lag, it's called by all tasks
+    :param max_attempts: max executions of a range
+    :return: rows, seconds, rows_per_second, missing, failed, workers
+    """
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(f"select min(id), max(id) from {table_name}")
+            min_id, max_id = await cur.fetchone()
+    if min_id is None:
+        return summarize_workers([], 0)
+    id_ranges = RangeQueue(split_id_range(min_id - 1, max_id, parts or workers * 4), max_attempts)
+    limiter = RateLimiter(rows_per_second) if rows_per_second else None
+
+    async def work(index):
+        start_time = time.monotonic()
+        rows, ranges, missing, error = 0, 0, 0, None
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                while True:
+                    item = id_ranges.get()
+                    if item is None:
+                        break
+                    (lower_id, upper_id), attempts = item
+                    try:
+                        report = await cur.backfill_history_range(table_name, lower_id, upper_id,
+                                                                  chunk_size=chunk_size, limiter=limiter,
+                                                                  operate_user=operate_user, sleep=sleep,
+                                                                  max_lag=max_lag, lag_checker=lag_checker)
+                    except Exception as e:
+                        id_ranges.retry((lower_id, upper_id), attempts + 1)
+                        error = repr(e)
+                        if is_retryable_error(e):
+                            continue
+                        # the connection may be broken
+                        break
+                    rows, ranges, missing = rows + report['rows'], ranges + 1, missing + report['missing']
+        return worker_report(index, rows, ranges, missing, time.monotonic() - start_time, error)
+
+    start_time = time.monotonic()
+    worker_reports = await asyncio.gather(*(work(index) for index in range(workers)))
+    return summarize_workers(list(worker_reports), time.monotonic() - start_time, id_ranges.remaining())
+
+
 class Pool(MysqlPool):
     """
     在原基础上，增加额外的功能
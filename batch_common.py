@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    公用文件，分批处理历史拉链表时的限速、检查点和进度统计
+
+"""
+
+import time
+import asyncio
+import inspect
+import threading
+from collections import deque
+
+# the checkpoint of archiving every history table
+ARCHIVE_POSITION_TABLE = '_history_archive_position'
+CREATE_ARCHIVE_POSITION_SQL = f"""
+    create table if not exists {ARCHIVE_POSITION_TABLE} (
+        history_table varchar(128) not null primary key, cutoff varchar(32) not null, last_id bigint not null
+    )
+"""
+QUERY_ARCHIVE_POSITION_SQL = f"select cutoff, last_id from {ARCHIVE_POSITION_TABLE} where history_table = %s"
+SAVE_ARCHIVE_POSITION_SQL = f"""
+    insert into {ARCHIVE_POSITION_TABLE} (history_table, cutoff, last_id) values (%s, %s, %s)
+    on duplicate key update cutoff = values(cutoff), last_id = values(last_id)
+"""
+
+# the checkpoint of backfilling every history table, it's deleted when the backfill completes
+BACKFILL_POSITION_TABLE = '_history_backfill_position'
+CREATE_BACKFILL_POSITION_SQL = f"""
+    create table if not exists {BACKFILL_POSITION_TABLE} (
+        history_table varchar(128) not null primary key, last_id bigint not null
+    )
+"""
+QUERY_BACKFILL_POSITION_SQL = f"select last_id from {BACKFILL_POSITION_TABLE} where history_table = %s"
+SAVE_BACKFILL_POSITION_SQL = f"""
+    insert into {BACKFILL_POSITION_TABLE} (history_table, last_id) values (%s, %s)
+    on duplicate key update last_id = values(last_id)
+"""
+DELETE_BACKFILL_POSITION_SQL = f"delete from {BACKFILL_POSITION_TABLE} where history_table = %s"
+
+# the parallel backfill runs every chunk at read committed, so the workers don't take gap locks on the ranges
+# of each other, it applies to the next transaction only and leaves the session's isolation level alone
+READ_COMMITTED_SQL = "set transaction isolation level read committed"
+START_TRANSACTION_SQL = "start transaction"
+# deadlock and lock wait timeout, the transaction is rolled back and can be executed again
+RETRYABLE_ERROR_CODES = (1213, 1205)
+# seconds to wait before the n-th retry is RETRY_WAIT * n
+RETRY_WAIT = 0.5
+
+
+def split_id_range(lower_id, upper_id, parts):
+    """
+    :param lower_id: exclusive
+    :param upper_id: inclusive
+    :param parts:
+    :return: [(lower_id, upper_id)], every range is (lower_id, upper_id]
+    """
+    step = max((upper_id - lower_id + parts - 1) // parts, 1)
+    return [(start, min(start + step, upper_id)) for start in range(lower_id, upper_id, step)]
+
+
+def is_retryable_error(error) -> bool:
+    """
+    :param error: pymysql.err.MySQLError
+    :return: whether it's a deadlock or lock wait timeout
+    """
+    return bool(error.args) and error.args[0] in RETRYABLE_ERROR_CODES
+
+
+def replica_lag_checker(replica_cursors):
+    """
+    :param replica_cursors: pymysql cursors of the replicas
+    :return: a function returns the max Seconds_Behind_Master of the replicas, None when replication is stopped,
+        the cursors are used by one thread at a time, so the workers of a parallel job can share it
+    """
+    lock = threading.Lock()
+
+    def check():
+        lags = []
+        with lock:
+            for cursor in replica_cursors:
+                cursor.execute("show slave status")
+                names = [column[0] for column in cursor.description or ()]
+                for row in cursor.fetchall():
+                    lags.append(dict(zip(names, row)).get('Seconds_Behind_Master'))
+        if any(lag is None for lag in lags):
+            return None
+        return max(lags) if lags else 0
+    return check
+
+
+class Throttle(object):
+    """
+    sleep between chunks, and wait while the replicas lag behind
+    """
+
+    def __init__(self, sleep=0.0, max_lag=None, lag_checker=None, lag_wait=1.0):
+        """
+        :param sleep: seconds to sleep between chunks
+        :param max_lag: wait while the replication lag is more than so many seconds, None means don't check
+        :param lag_checker: function (or coroutine function) returns the replication lag in seconds,
+            None means replication is stopped and it's waited too, eg: replica_lag_checker
+        :param lag_wait: seconds to sleep before checking lag again
+        """
+        self.sleep = sleep
+        self.max_lag = max_lag
+        self.lag_checker = lag_checker
+        self.lag_wait = lag_wait
+
+    def _lagging(self, lag):
+        return lag is None or lag > self.max_lag
+
+    def wait(self):
+        if self.sleep:
+            time.sleep(self.sleep)
+        if self.max_lag is None or self.lag_checker is None:
+            return
+        while self._lagging(self.lag_checker()):
+            time.sleep(self.lag_wait)
+
+    async def wait_async(self):
+        if self.sleep:
+            await asyncio.sleep(self.sleep)
+        if self.max_lag is None or self.lag_checker is None:
+            return
+        while True:
+            lag = self.lag_checker()
+            if inspect.isawaitable(lag):
+                lag = await lag
+            if not self._lagging(lag):
+                return
+            await asyncio.sleep(self.lag_wait)
+
+
+class BatchProgress(object):
+    """
+    rows and speed of a batch job
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.chunks = 0
+        self.last_id = None
+        self._start_time = time.monotonic()
+
+    def add(self, rows, last_id):
+        self.rows += rows
+        self.chunks += 1
+        self.last_id = last_id
+
+    def report(self) -> dict:
+        """
+        :return: rows, chunks, seconds, rows_per_second, last_id
+        """
+        seconds = time.monotonic() - self._start_time
+        return {
+            'rows': self.rows,
+            'chunks': self.chunks,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(self.rows / seconds, 1) if seconds > 0 else 0.0,
+            'last_id': self.last_id,
+        }
+
+
+def summarize_workers(worker_reports, seconds, failed=()) -> dict:
+    """
+    :param worker_reports: rows, ranges, seconds, rows_per_second, missing, error of every worker
+    :param seconds: the elapsed seconds of the job
+    :param failed: the (lower_id, upper_id) ranges which weren't backfilled, call the job again to retry them
+    :return: rows, seconds, rows_per_second, missing, failed, workers
+    """
+    rows = sum(report['rows'] for report in worker_reports)
+    return {
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 1) if seconds > 0 else 0.0,
+        'missing': sum(report['missing'] for report in worker_reports),
+        'failed': sorted(failed),
+        'workers': worker_reports,
+    }
+
+
+def worker_report(index, rows, ranges, missing, seconds, error=None) -> dict:
+    return {
+        'worker': index,
+        'rows': rows,
+        'ranges': ranges,
+        'missing': missing,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 1) if seconds > 0 else 0.0,
+        'error': error,
+    }
+
+
+class RangeQueue(object):
+    """
+    the id ranges of a parallel job shared by the workers (threads or tasks), a range whose backfill failed is
+    put back and taken by another worker, until it has failed max_attempts times
+    """
+
+    def __init__(self, id_ranges, max_attempts=3):
+        self.max_attempts = max_attempts
+        self.failed = []
+        self._ranges = deque((id_range, 0) for id_range in id_ranges)
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        :return: (id_range, attempts), None when no range is left
+        """
+        with self._lock:
+            return self._ranges.popleft() if self._ranges else None
+
+    def retry(self, id_range, attempts):
+        """
+        put back a failed range
+        :param id_range:
+        :param attempts: the failed attempts of the range, including this one
+        """
+        with self._lock:
+            if attempts < self.max_attempts:
+                self._ranges.append((id_range, attempts))
+            else:
+                self.failed.append(id_range)
+
+    def remaining(self) -> list:
+        """
+        :return: the failed ranges and the ranges no worker has taken
+        """
+        with self._lock:
+            return self.failed + [id_range for id_range, _ in self._ranges]
+
+
+class RateLimiter(object):
+    """
+    the rows per second budget shared by the workers (threads or tasks) of a batch job,
+    a worker reports the rows of every chunk and sleeps until the budget covers them
+    """
+
+    def __init__(self, rows_per_second):
+        self.rows_per_second = rows_per_second
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, rows):
+        """
+        :return: seconds to sleep
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._next_time = max(self._next_time, now) + rows / self.rows_per_second
+            return self._next_time - now
+
+    def consume(self, rows):
+        time.sleep(self._reserve(rows))
+
+    async def consume_async(self, rows):
+        await asyncio.sleep(self._reserve(rows))
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    读取row格式的binlog异步生成历史拉链表，写入路径上没有任何拉链表开销
+
+    usage:
+        from binlog_history import BinlogHistoryBuilder
+
+        builder = BinlogHistoryBuilder({'host': '127.0.0.1', 'user': 'repl', 'passwd': '***', 'db': 'test'}, 101)
+        builder.run()
+
+    main() parses the same options from the command line, eg: --user repl --db test --server-id 101
+
+"""
+
+import time
+import argparse
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+import pymysql
+from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.event import XidEvent
+from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+
+from .table_meta import HISTORY_ADDITIONAL_COLS, SCHEMA_META_SQL, build_schema_meta, check_history_columns
+
+RECORD_END_TIME = '9999-12-31'
+
+# the binlog position of every consumer and the time of its last version, updated in the same transaction as
+# the history rows
+BINLOG_POSITION_TABLE = '_history_binlog_position'
+CREATE_BINLOG_POSITION_SQL = f"""
+    create table if not exists {BINLOG_POSITION_TABLE} (
+        server_id int unsigned not null primary key, log_file varchar(255) not null, log_pos bigint unsigned not null,
+        last_time varchar(32) null
+    )
+"""
+VERSION_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class _RowVersions(object):
+    """
+    the history versions of a row produced by the buffered binlog events
+    """
+    __slots__ = ('end_time', 'versions')
+
+    def __init__(self):
+        # the time to end the version which was open before the batch, None means no such version
+        self.end_time = None
+        # [values, record_begin_time, record_end_time] list
+        self.versions = []
+
+    def close(self, current_time):
+        if self.versions:
+            if self.versions[-1][2] == RECORD_END_TIME:
+                self.versions[-1][2] = current_time
+        elif self.end_time is None:
+            self.end_time = current_time
+
+
+class BinlogHistoryBuilder(object):
+    """
+    a consumer reads the row events of binlog and writes history tables with the same versions as
+    Cursor._insert_history_record/_gen_end_history_sql, the writes are batched per table and committed together
+    with the binlog position, so a restarted consumer continues from the last committed transaction
+    the server must run with binlog_format=ROW and binlog_row_image=FULL
+    """
+
+    def __init__(self, connection_settings: dict, server_id: int, postfix='_history', base_column=None,
+                 tables=None, operate_user='', batch_rows=1000, flush_interval=1.0, start_log_file=None,
+                 start_log_pos=None):
+        """
+        :param connection_settings: host, port, user, passwd and db, the user needs REPLICATION SLAVE and
+            REPLICATION CLIENT privileges
+        :param server_id: the unique server id of this consumer
+        :param postfix: the history table's postfix
+        :param base_column:
+        :param tables: main tables, None means all tables which have a history table
+        :param operate_user: record_operate_user of the history rows, binlog doesn't carry the operate user
+        :param batch_rows: flush when so many rows are buffered
+        :param flush_interval: flush when so many seconds passed since the last flush
+        :param start_log_file: the binlog to start from at the first run, None means the current position of
+            the server, the events before it must have been written to history tables already
+        :param start_log_pos:
+        """
+        self.connection_settings = dict(connection_settings)
+        self.schema = self.connection_settings.pop('db')
+        self.server_id = server_id
+        self.postfix = postfix
+        self.base_column = base_column or ['id']
+        self.tables = tables
+        self.operate_user = operate_user
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.start_log_file = start_log_file
+        self.start_log_pos = start_log_pos
+        self.metas = {}
+        # table name -> {id: _RowVersions}
+        self._pending = OrderedDict()
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+        # the time of the last version, the binlog timestamps have one second precision
+        self._last_time = None
+        self._running = False
+        self._conn = None
+        self._stream = None
+
+    def _connect(self):
+        self._conn = pymysql.connect(db=self.schema, autocommit=False, **self.connection_settings)
+        with self._conn.cursor() as cursor:
+            cursor.execute(CREATE_BINLOG_POSITION_SQL)
+            cursor.execute(SCHEMA_META_SQL, [self.schema])
+            metas = build_schema_meta(cursor.fetchall(), self.postfix)
+        for meta in metas:
+            if self.tables is not None and meta.table_name not in self.tables:
+                continue
+            missing = check_history_columns(meta, self.base_column)
+            if missing:
+                raise ValueError("历史拉链表与主表字段不一致: {}{} missing column: {}".format(
+                    meta.table_name, self.postfix, ','.join(missing)))
+            self.metas[meta.table_name] = meta
+        self._conn.commit()
+
+    def _load_position(self):
+        """
+        :return: (log_file, log_pos) of the last committed batch, at the first run the start position,
+            or the current position of the server, so the applied events are not replayed
+        """
+        with self._conn.cursor() as cursor:
+            cursor.execute(f"select log_file, log_pos, last_time from {BINLOG_POSITION_TABLE} where server_id = %s",
+                           [self.server_id])
+            row = cursor.fetchone()
+            if row:
+                self._last_time = datetime.strptime(row[2], VERSION_TIME_FORMAT) if row[2] else None
+                row = row[:2]
+            elif self.start_log_file is not None:
+                row = (self.start_log_file, self.start_log_pos or 4)
+            elif not row:
+                cursor.execute("show master status")
+                status = cursor.fetchone()
+                if not status:
+                    raise ValueError("服务端未开启binlog")
+                row = status[:2]
+        self._conn.commit()
+        return row
+
+    def _row_versions(self, table_name, values):
+        """
+        the versions are keyed by id like the cursor's base_id, the other base columns may be NULL or changed
+        """
+        table_rows = self._pending.setdefault(table_name, OrderedDict())
+        row_versions = table_rows.get(values['id'])
+        if row_versions is None:
+            row_versions = table_rows[values['id']] = _RowVersions()
+        return row_versions
+
+    def _event_time(self, event):
+        """
+        the binlog timestamp has one second precision, the events of the same second get increasing microseconds,
+        so a version ended in the second it began isn't taken as a delete
+        :return: record time string
+        """
+        event_time = datetime.fromtimestamp(event.timestamp)
+        if self._last_time is not None and event_time <= self._last_time:
+            event_time = self._last_time + timedelta(microseconds=1)
+        self._last_time = event_time
+        return event_time.strftime(VERSION_TIME_FORMAT)
+
+    def add_event(self, event):
+        """
+        buffer the history versions of a row event
+        :param event: WriteRowsEvent, UpdateRowsEvent or DeleteRowsEvent
+        """
+        current_time = self._event_time(event)
+        for row in event.rows:
+            if isinstance(event, WriteRowsEvent):
+                values = row['values']
+                self._row_versions(event.table, values).versions.append([values, current_time, RECORD_END_TIME])
+            elif isinstance(event, UpdateRowsEvent):
+                values = row['after_values']
+                self._row_versions(event.table, row['before_values']).close(current_time)
+                self._row_versions(event.table, values).versions.append([values, current_time, RECORD_END_TIME])
+            elif isinstance(event, DeleteRowsEvent):
+                values = row['values']
+                row_versions = self._row_versions(event.table, values)
+                row_versions.close(current_time)
+                row_versions.versions.append([values, current_time, current_time])
+            self._pending_rows += 1
+
+    def _gen_end_history(self, table_name, table_rows):
+        """
+        :return: (sql, args) generator ending the versions which were open before the batch
+        """
+        history_table = table_name + self.postfix
+        ids_by_time = OrderedDict()
+        for row_id, row_versions in table_rows.items():
+            if row_versions.end_time is not None:
+                ids_by_time.setdefault(row_versions.end_time, []).append(row_id)
+        for end_time, ids in ids_by_time.items():
+            for start in range(0, len(ids), self.batch_rows):
+                chunk = ids[start:start + self.batch_rows]
+                sql = f"""update {history_table} set record_end_time = %s
+                    where base_id in ({','.join(['%s'] * len(chunk))}) and record_end_time = '{RECORD_END_TIME}'"""
+                yield sql, [end_time] + chunk
+
+    def _gen_insert_history(self, table_name, table_rows):
+        """
+        :return: (sql, args list) inserting the buffered versions
+        """
+        meta = self.metas[table_name]
+        cols = [name for name in meta.columns if name not in self.base_column]
+        base_columns = ['base_' + name for name in self.base_column]
+        history_col = ','.join(cols + list(HISTORY_ADDITIONAL_COLS) + base_columns)
+        place = ','.join(['%s'] * (len(cols) + len(HISTORY_ADDITIONAL_COLS) + len(base_columns)))
+        sql = f"insert into {table_name}{self.postfix} ({history_col}) values ({place})"
+        args = []
+        for row_versions in table_rows.values():
+            for values, begin_time, end_time in row_versions.versions:
+                args.append([values.get(name) for name in cols] + [begin_time, end_time, self.operate_user] +
+                            [values.get(name) for name in self.base_column])
+        return sql, args
+
+    def flush(self, log_file=None, log_pos=None):
+        """
+        write the buffered versions and the binlog position in one transaction
+        :param log_file: binlog position after the last buffered transaction
+        :param log_pos:
+        :return: Number of history rows inserted
+        """
+        rows = 0
+        try:
+            with self._conn.cursor() as cursor:
+                for table_name, table_rows in self._pending.items():
+                    for sql, args in self._gen_end_history(table_name, table_rows):
+                        cursor.execute(sql, args)
+                    sql, args = self._gen_insert_history(table_name, table_rows)
+                    for start in range(0, len(args), self.batch_rows):
+                        rows += cursor.executemany(sql, args[start:start + self.batch_rows]) or 0
+                if log_file is not None:
+                    last_time = self._last_time.strftime(VERSION_TIME_FORMAT) if self._last_time else None
+                    cursor.execute(f"""insert into {BINLOG_POSITION_TABLE} (server_id, log_file, log_pos, last_time)
+                        values (%s, %s, %s, %s) on duplicate key update log_file = values(log_file),
+                        log_pos = values(log_pos), last_time = values(last_time)""",
+                                   [self.server_id, log_file, log_pos, last_time])
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        self._pending.clear()
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+        return rows
+
+    def run(self):
+        """
+        consume binlog until stop() is called, flush only at transaction boundaries (XidEvent)
+        """
+        self._connect()
+        log_file, log_pos = self._load_position()
+        self._stream = BinLogStreamReader(
+            connection_settings=self.connection_settings, server_id=self.server_id,
+            only_schemas=[self.schema], only_tables=list(self.metas),
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, XidEvent],
+            blocking=True, resume_stream=True, log_file=log_file, log_pos=log_pos)
+        self._running = True
+        try:
+            for event in self._stream:
+                if isinstance(event, XidEvent):
+                    if self._pending_rows >= self.batch_rows or \
+                            time.monotonic() - self._last_flush >= self.flush_interval:
+                        self.flush(self._stream.log_file, self._stream.log_pos)
+                elif event.table in self.metas:
+                    self.add_event(event)
+                if not self._running:
+                    break
+        finally:
+            self._stream.close()
+            self._conn.close()
+
+    def stop(self):
+        """
+        stop consuming after the current event, the unflushed transactions are consumed again at next run
+        """
+        self._running = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='build history tables from binlog')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--server-id', type=int, required=True)
+    parser.add_argument('--postfix', default='_history')
+    parser.add_argument('--base-column', nargs='+', default=['id'])
+    parser.add_argument('--tables', nargs='+', default=None)
+    parser.add_argument('--operate-user', default='')
+    parser.add_argument('--batch-rows', type=int, default=1000)
+    parser.add_argument('--flush-interval', type=float, default=1.0)
+    parser.add_argument('--start-log-file', default=None)
+    parser.add_argument('--start-log-pos', type=int, default=None)
+    options = parser.parse_args()
+    connection_settings = {'host': options.host, 'port': options.port, 'user': options.user,
+                           'passwd': options.password, 'db': options.db}
+    builder = BinlogHistoryBuilder(connection_settings, options.server_id, postfix=options.postfix,
+                                   base_column=options.base_column, tables=options.tables,
+                                   operate_user=options.operate_user, batch_rows=options.batch_rows,
+                                   flush_interval=options.flush_interval, start_log_file=options.start_log_file,
+                                   start_log_pos=options.start_log_pos)
+    try:
+        builder.run()
+    except KeyboardInterrupt:
+        builder.stop()
+
+
+if __name__ == '__main__':
+    main()
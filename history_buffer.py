@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    事务内的历史拉链缓冲，提交时每张表只写一次拉链表
+
+"""
+
+from collections import OrderedDict
+
+from .parse_common import IdRanges
+
+
+class HistoryBuffer(object):
+    """
+    the rows inserted or updated in current transaction, a row touched many times gets only one history version
+    when the transaction commits
+    """
+
+    def __init__(self):
+        # table name -> {primary key: operate user}
+        self._tables = OrderedDict()
+
+    def add(self, table_name: str, ids, operate_user: str):
+        """
+        :param table_name: main table
+        :param ids: primary keys of the touched rows
+        :param operate_user: the last user touching the rows
+        """
+        table_ids = self._tables.setdefault(table_name, {})
+        for _id in ids:
+            if _id is not None:
+                table_ids[_id] = operate_user
+
+    def has_table(self, table_name: str) -> bool:
+        return bool(self._tables.get(table_name))
+
+    def pop(self, table_name: str, ids):
+        """
+        remove the rows being deleted, their buffered versions must be written before the delete version
+        :param table_name: main table
+        :param ids: primary keys of the deleted rows
+        :return: (table name, operate user, IdRanges) generator of the buffered rows among them
+        """
+        table_ids = self._tables.get(table_name)
+        if not table_ids:
+            return
+        user_ids = {}
+        for _id in ids:
+            if _id in table_ids:
+                user_ids.setdefault(table_ids.pop(_id), []).append(_id)
+        for operate_user, ids in user_ids.items():
+            yield table_name, operate_user, IdRanges.from_ids(ids)
+
+    def items(self):
+        """
+        :return: (table name, operate user, IdRanges) generator
+        """
+        for table_name, table_ids in self._tables.items():
+            user_ids = {}
+            for _id, operate_user in table_ids.items():
+                user_ids.setdefault(operate_user, []).append(_id)
+            for operate_user, ids in user_ids.items():
+                yield table_name, operate_user, IdRanges.from_ids(ids)
+
+    def clear(self):
+        self._tables.clear()
+
+    def __bool__(self):
+        return any(self._tables.values())
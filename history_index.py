@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    历史拉链表索引建议，生成建索引的DDL，并对游标实际生成的sql执行EXPLAIN检查全表扫描
+
+"""
+
+from datetime import datetime
+from collections import namedtuple
+
+from .parse_common import ParseSQL, IdRanges
+from .table_meta import SCHEMA_META_SQL, build_schema_meta
+
+# the indexes of all tables in a schema
+SCHEMA_INDEX_SQL = """
+    select table_name, index_name, column_name from information_schema.statistics
+    where table_schema = %s order by table_name, index_name, seq_in_index
+"""
+
+# the access types of EXPLAIN which read the whole table or index
+FULL_SCAN_TYPES = ('ALL', 'index')
+
+
+class ExplainResult(namedtuple('ExplainResult', ['table_name', 'purpose', 'sql', 'full_scans'])):
+    """
+    EXPLAIN of a statement the cursor generates
+        purpose: which operation generates the statement
+        full_scans: the EXPLAIN rows (dict) whose type is ALL or index
+    """
+    __slots__ = ()
+
+
+def recommend_history_indexes() -> list:
+    """
+    the indexes a history table needs, the cursor looks up the history rows by base_id only, the other base
+    columns would only make the indexes wider:
+        (base_id, record_end_time): ending the open versions
+        (base_id, record_begin_time): the versions of a row in time order (_query_history_data,
+            analysis_process_many) and its last version (_query_history_last_data), InnoDB appends the primary key
+            id to the index, so the "record_begin_time, id" order needs no filesort
+        (record_begin_time, record_end_time): querying the rows at a history time
+    :return: column list of every index
+    """
+    return [['base_id', 'record_end_time'], ['base_id', 'record_begin_time'], ['record_begin_time', 'record_end_time']]
+
+
+def gen_history_index_ddl(history_table: str, indexes: dict) -> list:
+    """
+    generate the DDL of the recommended indexes which the history table lacks,
+    an existing index whose leading columns are the recommended ones is enough
+    :param history_table:
+    :param indexes: the existing indexes of history table, {index name: column list}
+    :return: alter table statements
+    """
+    ddl_li = []
+    for columns in recommend_history_indexes():
+        if any(index_columns[:len(columns)] == columns for index_columns in indexes.values()):
+            continue
+        index_name = 'idx_' + '_'.join(columns)
+        ddl_li.append(f"alter table {history_table} add index {index_name} ({','.join(columns)})")
+    return ddl_li
+
+
+class HistoryIndexAdvisor(object):
+    """
+    inspect every main/history table pair of the schema, usage:
+        advisor = HistoryIndexAdvisor(conn.cursor())
+        for sql in advisor.advise(): print(sql)
+        for result in advisor.explain(): print(result.sql, result.full_scans)
+    """
+
+    def __init__(self, cursor):
+        """
+        :param cursor: pymysql_connection.Cursor, the statements are generated the same way as it writes history
+        """
+        self.cursor = cursor
+        self.postfix = cursor._history_posix
+
+    def _query(self, sql, args=None):
+        """
+        :return: dict rows, the keys are lower case
+        """
+        cursor = self.cursor._get_history_cursor()
+        cursor.execute(sql, args)
+        names = [column[0].lower() for column in cursor.description or ()]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def _load(self, table_names=None):
+        """
+        :return: TableMeta list, {table name: {index name: column list}}
+        """
+        schema = self.cursor._get_db().db.decode()
+        rows = self._query(SCHEMA_META_SQL, [schema])
+        metas = build_schema_meta([(row['table_name'], row['column_name'], row['column_key']) for row in rows],
+                                  self.postfix)
+        if table_names is not None:
+            metas = [meta for meta in metas if meta.table_name in table_names]
+        table_indexes = {}
+        for row in self._query(SCHEMA_INDEX_SQL, [schema]):
+            indexes = table_indexes.setdefault(row['table_name'], {})
+            indexes.setdefault(row['index_name'], []).append(row['column_name'])
+        return metas, table_indexes
+
+    def advise(self, table_names=None) -> list:
+        """
+        :param table_names: main tables, None means all tables which have a history table
+        :return: alter table statements of the missing indexes
+        """
+        metas, table_indexes = self._load(table_names)
+        ddl_li = []
+        for meta in metas:
+            history_table = meta.table_name + self.postfix
+            ddl_li += gen_history_index_ddl(history_table, table_indexes.get(history_table, {}))
+        return ddl_li
+
+    def gen_history_statements(self, table_name: str) -> list:
+        """
+        the statements the cursor generates to maintain and query the history table of a main table
+        :param table_name: main table
+        :return: (purpose, sql) list
+        """
+        cursor = self.cursor
+        history_table = table_name + self.postfix
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        end_sql = next(cursor._gen_end_history_sql_by_ids(table_name, IdRanges([(1, 1)]), current_time))
+        history_query = ParseSQL(f"select * from {table_name}", cursor.base_column).history_query(
+            current_time, self.postfix)
+        cols = [name for name in cursor._extract_table_column(table_name) if name not in cursor.base_column]
+        base_columns = ['base_' + name for name in cursor.base_column]
+        history_col = ','.join(cols + cursor.history_additional_cols + base_columns)
+        last_data_sql = cursor._gen_query_history_last_data_sql(history_table, history_col)
+        data_sql = cursor._gen_query_history_data_sql(history_table, history_col)
+        return [
+            ('_gen_end_history_sql', end_sql),
+            ('execute_history', history_query),
+            ('_query_history_last_data', cursor.mogrify(last_data_sql, [1])),
+            ('_query_history_data', cursor.mogrify(data_sql, [1])),
+        ]
+
+    def explain(self, table_names=None) -> list:
+        """
+        run EXPLAIN on the statements of gen_history_statements
+        :param table_names: main tables, None means all tables which have a history table
+        :return: ExplainResult list
+        """
+        metas, _ = self._load(table_names)
+        results = []
+        for meta in metas:
+            for purpose, sql in self.gen_history_statements(meta.table_name):
+                rows = self._query('explain ' + sql)
+                full_scans = [row for row in rows if row.get('type') in FULL_SCAN_TYPES]
+                results.append(ExplainResult(meta.table_name, purpose, ' '.join(sql.split()), full_scans))
+        return results
+
+    def report(self, table_names=None) -> str:
+        """
+        :param table_names: main tables, None means all tables which have a history table
+        :return: the missing indexes and the statements which still scan the whole table
+        """
+        lines = ['-- missing indexes'] + [sql + ';' for sql in self.advise(table_names)]
+        lines.append('-- full scans')
+        for result in self.explain(table_names):
+            for row in result.full_scans:
+                lines.append(f"{result.table_name} {result.purpose}: {row.get('table')} type={row.get('type')} "
+                             f"rows={row.get('rows')} | {result.sql}")
+        return '\n'.join(lines)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    历史拉链表按 record_end_time 做 RANGE 分区，未结束的版本(9999-12-31)单独放在 p_open 分区
+
+    分区布局:
+        p20260101 ... : 按月存放已结束的版本，values less than 每月第一天
+        p_future      : values less than ('9999-12-31')，rotate 时从中拆出新的月分区
+        p_open        : values less than (MAXVALUE)，只有未结束的版本，结束版本的update只访问该分区
+
+"""
+
+from datetime import date
+from collections import OrderedDict
+
+OPEN_PARTITION = 'p_open'
+FUTURE_PARTITION = 'p_future'
+RECORD_END_TIME = '9999-12-31'
+
+# the partitions of a table
+TABLE_PARTITION_SQL = """
+    select partition_name, partition_description from information_schema.partitions
+    where table_schema = %s and table_name = %s and partition_name is not null order by partition_ordinal_position
+"""
+
+
+def month_bounds(start: date, months: int) -> list:
+    """
+    :param start: the month of the first bound
+    :param months: number of bounds
+    :return: the first day of every month from start
+    """
+    year, month = start.year, start.month
+    bounds = []
+    for _ in range(months):
+        bounds.append(date(year, month, 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return bounds
+
+
+def partition_name(bound: date) -> str:
+    return 'p' + bound.strftime('%Y%m%d')
+
+
+def _partition_definition(bound: date) -> str:
+    return f"partition {partition_name(bound)} values less than ('{bound.isoformat()}')"
+
+
+def gen_partition_history_ddl(history_table: str, bounds) -> list:
+    """
+    generate the DDL which partitions a history table by range columns (record_end_time),
+    record_end_time must be a DATE or DATETIME column, and every unique key must include it, so the primary key
+    becomes (id, record_end_time)
+    :param history_table:
+    :param bounds: the upper bounds (date) of the closed partitions, eg: month_bounds(date(2026, 1, 1), 12)
+    :return: alter table statements
+    """
+    definitions = [_partition_definition(bound) for bound in sorted(bounds)]
+    definitions.append(f"partition {FUTURE_PARTITION} values less than ('{RECORD_END_TIME}')")
+    definitions.append(f"partition {OPEN_PARTITION} values less than (MAXVALUE)")
+    return [
+        f"alter table {history_table} drop primary key, add primary key (id, record_end_time)",
+        f"alter table {history_table} partition by range columns (record_end_time) ({', '.join(definitions)})",
+    ]
+
+
+def parse_partition_bound(description: str) -> date:
+    """
+    :param description: partition_description of information_schema.partitions, eg: '2026-01-01' or MAXVALUE
+    :return: None for MAXVALUE
+    """
+    value = (description or '').strip().strip("'")
+    if not value or value.upper() == 'MAXVALUE':
+        return None
+    return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+
+def gen_rotate_partition_ddl(history_table: str, partitions: dict, bounds, drop_before: date = None) -> list:
+    """
+    generate the DDL which splits the new month partitions from p_future and drops the expired ones
+    :param history_table:
+    :param partitions: the existing partitions, {partition name: upper bound}
+    :param bounds: the upper bounds the table should have
+    :param drop_before: drop the partitions whose upper bound is not after it, None means keep all
+    :return: alter table statements
+    """
+    existing = {bound for name, bound in partitions.items() if name not in (FUTURE_PARTITION, OPEN_PARTITION)}
+    last_bound = max(existing) if existing else None
+    new_bounds = sorted(bound for bound in bounds if last_bound is None or bound > last_bound)
+    ddl_li = []
+    if new_bounds:
+        definitions = [_partition_definition(bound) for bound in new_bounds]
+        definitions.append(f"partition {FUTURE_PARTITION} values less than ('{RECORD_END_TIME}')")
+        ddl_li.append(f"alter table {history_table} reorganize partition {FUTURE_PARTITION} "
+                      f"into ({', '.join(definitions)})")
+    if drop_before is not None:
+        expired = [name for name, bound in partitions.items()
+                   if name not in (FUTURE_PARTITION, OPEN_PARTITION) and bound <= drop_before]
+        if expired:
+            ddl_li.append(f"alter table {history_table} drop partition {', '.join(expired)}")
+    return ddl_li
+
+
+class HistoryPartitionManager(object):
+    """
+    partition the history tables and rotate their partitions, call rotate() from a daily scheduled job, eg:
+        manager = HistoryPartitionManager(conn.cursor())
+        manager.rotate('tag', months_ahead=3, retention_months=24)
+    """
+
+    def __init__(self, cursor):
+        """
+        :param cursor: pymysql_connection.Cursor
+        """
+        self.cursor = cursor
+        self.postfix = cursor._history_posix
+
+    def _execute(self, sql, args=None):
+        cursor = self.cursor._get_history_cursor()
+        cursor.execute(sql, args)
+        return cursor.fetchall()
+
+    def partitions(self, table_name: str) -> OrderedDict:
+        """
+        :param table_name: main table
+        :return: {partition name: upper bound} of its history table, empty if it's not partitioned
+        """
+        schema = self.cursor._get_db().db.decode()
+        rows = self._execute(TABLE_PARTITION_SQL, [schema, table_name + self.postfix])
+        return OrderedDict((name, parse_partition_bound(description)) for name, description in rows)
+
+    def partition(self, table_name: str, start: date, months: int = 12) -> list:
+        """
+        partition the history table of a main table, the closed versions before start go to the first partition
+        :param table_name: main table
+        :param start: the month of the first partition bound
+        :param months: number of month partitions
+        :return: the executed statements
+        """
+        ddl_li = gen_partition_history_ddl(table_name + self.postfix, month_bounds(start, months))
+        for sql in ddl_li:
+            self._execute(sql)
+        return ddl_li
+
+    def rotate(self, table_name: str, months_ahead: int = 3, retention_months: int = None, today: date = None) -> list:
+        """
+        make sure the month partitions exist up to months_ahead, drop those older than retention_months
+        :param table_name: main table
+        :param months_ahead:
+        :param retention_months: None means keep all
+        :param today:
+        :return: the executed statements
+        """
+        today = today or date.today()
+        partitions = self.partitions(table_name)
+        if not partitions:
+            raise ValueError(f"历史拉链表未分区: {table_name}{self.postfix}")
+        bounds = month_bounds(today, months_ahead + 2)[1:]
+        drop_before = None
+        if retention_months is not None:
+            months = today.year * 12 + today.month - 1 - retention_months
+            drop_before = date(months // 12, months % 12 + 1, 1)
+        ddl_li = gen_rotate_partition_ddl(table_name + self.postfix, partitions, bounds, drop_before)
+        for sql in ddl_li:
+            self._execute(sql)
+        return ddl_li
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    把若干表在某一历史时刻的数据物化为快照表，同一时刻的多次分析查询直接查快照表
+
+"""
+
+import re
+from datetime import datetime
+
+from .table_meta import TableMeta
+
+SNAPSHOT_POSTFIX = '_snapshot_'
+# the named snapshot tables keep their expire time in the table comment
+SNAPSHOT_COMMENT = 'history snapshot expire at '
+SNAPSHOT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# group 1: a string literal or a comment, which is kept; group 2: the backtick, group 3: an identifier not
+# qualified by another one
+RE_SNAPSHOT_TOKEN = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|--[^\n]*|#[^\n]*|/\*.*?\*/)"""
+                               r"""|(?<![\w$@.`])(`?)([\w$]+)\2(?![\w$`])""", re.DOTALL)
+
+NAMED_SNAPSHOT_SQL = f"""
+    select table_name, table_comment from information_schema.tables
+    where table_schema = %s and table_comment like '{SNAPSHOT_COMMENT}%%'
+"""
+
+
+def snapshot_postfix(history_time: datetime) -> str:
+    """
+    :param history_time:
+    :return: the postfix of the snapshot tables, eg: _snapshot_20260101120000
+    """
+    return SNAPSHOT_POSTFIX + history_time.strftime('%Y%m%d%H%M%S')
+
+
+def gen_snapshot_sql(meta: TableMeta, base_column, history_postfix: str, postfix: str, history_time: str,
+                     temporary: bool = True, expire_time: datetime = None) -> list:
+    """
+    generate the statements materializing a main table at history_time, the snapshot table has the columns and
+    the primary key of main table, the versions are half-open [record_begin_time, record_end_time), so the version
+    ended at history_time and the delete versions aren't selected
+    :param meta: TableMeta of main table
+    :param base_column:
+    :param history_postfix: history table's postfix
+    :param postfix: snapshot postfix
+    :param history_time:
+    :param temporary: whether to create a session temporary table
+    :param expire_time: the expire time of a named snapshot, it's kept in the table comment
+    :return: statements
+    """
+    base_column = base_column or ['id']
+    snapshot_table = meta.table_name + postfix
+    primary_key = ','.join(meta.primary_key or base_column)
+    select_col = ','.join(f'base_{name} as {name}' if name in base_column else name for name in meta.columns)
+    comment = f" comment = '{SNAPSHOT_COMMENT}{expire_time.strftime(SNAPSHOT_TIME_FORMAT)}'" \
+        if expire_time is not None and not temporary else ''
+    return [
+        f"drop {'temporary ' if temporary else ''}table if exists {snapshot_table}",
+        f"""create {'temporary ' if temporary else ''}table {snapshot_table} (primary key ({primary_key})){comment}
+            ignore select {select_col} from {meta.table_name}{history_postfix}
+            where record_begin_time <= '{history_time}' and record_end_time > '{history_time}'""",
+    ]
+
+
+def gen_drop_snapshot_sql(table_names, postfix: str, temporary: bool = True) -> list:
+    return [f"drop {'temporary ' if temporary else ''}table if exists {table_name}{postfix}"
+            for table_name in table_names]
+
+
+def gen_snapshot_query(query: str, table_names, postfix: str) -> str:
+    """
+    remap the main tables of a query to their snapshot tables, a table name may be quoted by backticks and
+    followed by any whitespace or punctuation, the qualifier of a column (table.column) is remapped too,
+    the names qualified by a schema, in string literals and in comments are kept
+    :param query:
+    :param table_names: main tables of the snapshot
+    :param postfix: snapshot postfix
+    :return:
+    """
+    table_names = set(table_names)
+    remapped = []
+
+    def remap(match):
+        if match.group(1) or match.group(3) not in table_names:
+            return match.group(0)
+        remapped.append(match.group(3))
+        return f'{match.group(2)}{match.group(3)}{postfix}{match.group(2)}'
+    snapshot_query = RE_SNAPSHOT_TOKEN.sub(remap, query.strip().rstrip(';'))
+    if not remapped:
+        # the query would read the live tables
+        raise ValueError(f"查询中没有快照的主表: {', '.join(sorted(table_names))}")
+    return snapshot_query
+
+
+def expired_named_snapshots(rows, now: datetime) -> list:
+    """
+    :param rows: (table_name, table_comment) rows of NAMED_SNAPSHOT_SQL
+    :param now:
+    :return: the expired snapshot table names
+    """
+    expired = []
+    for table_name, comment in rows:
+        try:
+            expire_time = datetime.strptime(comment[len(SNAPSHOT_COMMENT):], SNAPSHOT_TIME_FORMAT)
+        except ValueError:
+            continue
+        if expire_time <= now:
+            expired.append(table_name)
+    return expired
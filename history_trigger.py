@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    触发器方式维护历史拉链表，拉链表由服务端写入，其他工具的增删改同样会记录
+
+"""
+
+from .table_meta import TableMeta, HISTORY_ADDITIONAL_COLS
+
+# the session variables the cursor passes to the triggers
+HISTORY_USER_VARIABLE = '@history_operate_user'
+HISTORY_SKIP_VARIABLE = '@history_skip'
+
+SET_HISTORY_SESSION_SQL = f"set {HISTORY_USER_VARIABLE} = %s, {HISTORY_SKIP_VARIABLE} = %s"
+
+UNLOCK_TABLES_SQL = 'unlock tables'
+
+TRIGGER_EVENTS = ('insert', 'update', 'delete')
+
+RECORD_END_TIME = '9999-12-31'
+
+
+def history_trigger_names(table_name: str, postfix: str) -> list:
+    """
+    :param table_name: main table
+    :param postfix: history table's postfix
+    :return: the trigger names of insert, update and delete
+    """
+    return [f'{table_name}{postfix}_after_{event}' for event in TRIGGER_EVENTS]
+
+
+def _gen_insert_history(meta: TableMeta, base_column, postfix, row, record_end_time):
+    """
+    :param row: NEW or OLD
+    :param record_end_time: sql expression of record_end_time
+    """
+    cols = [name for name in meta.columns if name not in base_column]
+    history_col = ','.join(cols + list(HISTORY_ADDITIONAL_COLS) + ['base_' + name for name in base_column])
+    values = ', '.join([f'{row}.{name}' for name in cols] +
+                       ['now(6)', record_end_time, f"coalesce({HISTORY_USER_VARIABLE}, '')"] +
+                       [f'{row}.{name}' for name in base_column])
+    return f"insert into {meta.table_name}{postfix} ({history_col}) values ({values});"
+
+
+def _gen_end_history(meta: TableMeta, postfix):
+    """
+    end the open version by base_id only like Cursor._gen_end_history_sql_by_ids, the other base columns may be
+    NULL or changed by the update
+    """
+    return f"""update {meta.table_name}{postfix} set record_end_time = now(6)
+            where base_id = OLD.id and record_end_time = '{RECORD_END_TIME}';"""
+
+
+def gen_history_trigger_sql(meta: TableMeta, base_column, postfix: str) -> list:
+    """
+    generate the AFTER INSERT/UPDATE/DELETE triggers which maintain the history table of a main table,
+    the same versions as Cursor writes: an update ends the open version and inserts a new one,
+    a delete inserts a version whose record_begin_time equals record_end_time
+    :param meta: TableMeta of main table
+    :param base_column:
+    :param postfix: history table's postfix
+    :return: create trigger statements
+    """
+    base_column = base_column or []
+    bodies = [
+        [_gen_insert_history(meta, base_column, postfix, 'NEW', f"'{RECORD_END_TIME}'")],
+        [_gen_end_history(meta, postfix),
+         _gen_insert_history(meta, base_column, postfix, 'NEW', f"'{RECORD_END_TIME}'")],
+        [_gen_end_history(meta, postfix),
+         _gen_insert_history(meta, base_column, postfix, 'OLD', 'now(6)')],
+    ]
+    sql_li = []
+    for trigger_name, event, body in zip(history_trigger_names(meta.table_name, postfix), TRIGGER_EVENTS, bodies):
+        body_sql = '\n            '.join(body)
+        sql_li.append(f"""
+        create trigger {trigger_name} after {event} on {meta.table_name} for each row
+        begin
+          if coalesce({HISTORY_SKIP_VARIABLE}, 0) = 0 then
+            {body_sql}
+          end if;
+        end""")
+    return sql_li
+
+
+def gen_drop_history_trigger_sql(table_name: str, postfix: str) -> list:
+    """
+    :param table_name: main table
+    :param postfix: history table's postfix
+    :return: drop trigger statements
+    """
+    return [f'drop trigger if exists {trigger_name}' for trigger_name in history_trigger_names(table_name, postfix)]
+
+
+def gen_swap_history_trigger_sql(meta: TableMeta, base_column, postfix: str) -> list:
+    """
+    replace the triggers of a main table, the tables are locked for the swap, so no DML lands between dropping
+    the old triggers and creating the new ones, the trigger statements keep the lock and UNLOCK TABLES releases it
+    :param meta: TableMeta of main table
+    :param base_column:
+    :param postfix: history table's postfix
+    :return: statements
+    """
+    return ([f'lock tables {meta.table_name} write, {meta.table_name}{postfix} write'] +
+            gen_drop_history_trigger_sql(meta.table_name, postfix) +
+            gen_history_trigger_sql(meta, base_column, postfix))
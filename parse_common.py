@@ -7,8 +7,11 @@
 """
 
 import re
+import threading
 from enum import Enum
 from copy import deepcopy
+from types import MappingProxyType
+from collections import OrderedDict, namedtuple
 from sqlparse import parse, tokens
 from sqlparse.sql import IdentifierList, Identifier, Function, Where, Parenthesis, Token
 from sqlparse.tokens import Keyword, DML
@@ -17,6 +20,10 @@ INSERT_OPTION = ['LOW_PRIORITY', 'DELAYED', 'HIGH_PRIORITY', 'IGNORE']
 DELETE_OPTION = ['LOW_PRIORITY', 'QUICK', 'IGNORE']
 UPDATE_OPTION = ['LOW_PRIORITY', 'IGNORE']
 
+# skip the leading whitespace, comments and parentheses then match the first keyword
+# an executable comment (/*! ... */) is not skipped, so it would not match
+RE_LEADING_KEYWORD = re.compile(r'(?:\s+|--[^\n]*(?:\n|\Z)|#[^\n]*(?:\n|\Z)|/\*(?!!).*?\*/|\()*([A-Za-z]+)', re.DOTALL)
+
 
 class DMLType(Enum):
     INSERT = 'INSERT'
@@ -24,6 +31,208 @@ class DMLType(Enum):
     DELETE = 'DELETE'
 
 
+HISTORY_STMT_TYPE = frozenset(dml_type.value for dml_type in DMLType)
+
+# the statements which commit current transaction implicitly
+IMPLICIT_COMMIT_STMT_TYPE = frozenset(('ALTER', 'CREATE', 'DROP', 'RENAME', 'TRUNCATE', 'LOCK', 'BEGIN', 'START',
+                                       'GRANT', 'REVOKE', 'ANALYZE', 'OPTIMIZE', 'REPAIR'))
+# the statements which commit current transaction, explicitly or implicitly
+COMMIT_STMT_TYPE = IMPLICIT_COMMIT_STMT_TYPE | {'COMMIT'}
+# the rest of ROLLBACK [WORK] TO [SAVEPOINT] name, which rolls back only the statements after the savepoint
+RE_ROLLBACK_TO = re.compile(r'\s+(?:WORK\s+)?TO\b', re.IGNORECASE)
+# enabling autocommit commits current transaction
+RE_SET_AUTOCOMMIT = re.compile(r'\s+(?:SESSION\s+|@@(?:SESSION\.)?)?AUTOCOMMIT\s*=\s*(?:1|ON|TRUE)\b', re.IGNORECASE)
+
+
+class PkCapture(Enum):
+    """
+    how UPDATE/DELETE capture the primary keys of affected rows:
+        :client fetch the keys to python
+        :temp_table keep the keys in a session temporary table, they never leave the server
+    """
+    CLIENT = 'client'
+    TEMP_TABLE = 'temp_table'
+
+
+class HistoryMode(Enum):
+    """
+    who writes the history tables:
+        :client the cursor writes them around every INSERT, UPDATE and DELETE
+        :trigger the triggers of main tables write them, the cursor only passes the operate user
+    """
+    CLIENT = 'client'
+    TRIGGER = 'trigger'
+
+
+# the session temporary table which keeps the captured primary keys
+HISTORY_KEYS_TABLE = '_history_keys'
+CREATE_HISTORY_KEYS_SQL = f"""
+    create temporary table if not exists {HISTORY_KEYS_TABLE} (
+        table_index smallint unsigned not null, id bigint unsigned not null, primary key (table_index, id)
+    )
+"""
+
+# the trailing semicolons and whitespace of a statement
+RE_STATEMENT_END = re.compile(r'[\s;]+\Z')
+
+
+def strip_statement_end(sql: str) -> str:
+    """
+    strip the trailing semicolons of a statement, so it can be followed by another statement or clause,
+    whatever follows it must start on a new line, which ends a trailing -- or # comment
+    :param sql:
+    :return:
+    """
+    return RE_STATEMENT_END.sub('', sql)
+
+
+# the single-table DELETE syntax, only it accepts RETURNING on MariaDB
+RE_SINGLE_TABLE_DELETE = re.compile(r'\s*DELETE\s+(?:(?:LOW_PRIORITY|QUICK|IGNORE)\s+)*FROM\s', re.IGNORECASE)
+
+RE_MARIADB_VERSION = re.compile(r'(?:5\.5\.5-)?(\d+)\.(\d+)\.(\d+)-MariaDB', re.IGNORECASE)
+
+
+def supports_delete_returning(server_version: str) -> bool:
+    """
+    whether the server supports DELETE ... RETURNING, MariaDB 10.0.5 and later
+    :param server_version: eg: 5.5.5-10.4.12-MariaDB-log
+    :return:
+    """
+    match = RE_MARIADB_VERSION.search(server_version or '')
+    return match is not None and tuple(int(part) for part in match.groups()) >= (10, 0, 5)
+
+
+def get_leading_keyword(sql: str) -> str:
+    """
+    a lightweight scanner returns the first keyword of a statement without parsing it
+    :param sql:
+    :return: the upper keyword, None when it can't be determined
+    """
+    match = RE_LEADING_KEYWORD.match(sql)
+    return match.group(1).upper() if match else None
+
+
+def need_history_plan(sql: str) -> bool:
+    """
+    whether a statement may be INSERT, UPDATE or DELETE, other statements skip sqlparse completely
+    :param sql:
+    :return:
+    """
+    keyword = get_leading_keyword(sql)
+    return keyword is None or keyword in HISTORY_STMT_TYPE
+
+
+def get_transaction_end(sql: str) -> str:
+    """
+    whether a statement ends current transaction, like Connection.commit/rollback do
+    :param sql:
+    :return: 'COMMIT' for COMMIT, BEGIN, SET autocommit = 1 and the statements causing an implicit commit,
+        'ROLLBACK' for ROLLBACK except ROLLBACK TO SAVEPOINT, otherwise None
+    """
+    match = RE_LEADING_KEYWORD.match(sql)
+    if not match:
+        return None
+    keyword = match.group(1).upper()
+    if keyword in COMMIT_STMT_TYPE:
+        return 'COMMIT'
+    if keyword == 'ROLLBACK':
+        return None if RE_ROLLBACK_TO.match(sql, match.end()) else 'ROLLBACK'
+    if keyword == 'SET' and RE_SET_AUTOCOMMIT.match(sql, match.end()):
+        return 'COMMIT'
+    return None
+
+
+class IdRanges(object):
+    """
+    compact representation of an id set, consecutive ids are kept as (first_id, count) pairs,
+    so the size of it and the sql condition of it don't grow with the number of ids
+    """
+    __slots__ = ('pairs',)
+
+    def __init__(self, pairs=None):
+        """
+        :param pairs: (first_id, count) list, eg: cursor.pairs
+        """
+        self.pairs = [(first_id, count) for first_id, count in pairs or () if count > 0]
+
+    @classmethod
+    def from_ids(cls, ids):
+        """
+        :param ids: integer id iterable, it can be unordered and repeated, None is ignored
+        :return:
+        """
+        pairs = []
+        for _id in sorted(set(_id for _id in ids if _id is not None)):
+            if pairs and pairs[-1][0] + pairs[-1][1] == _id:
+                pairs[-1] = (pairs[-1][0], pairs[-1][1] + 1)
+            else:
+                pairs.append((_id, 1))
+        return cls(pairs)
+
+    def __len__(self):
+        return sum(count for _, count in self.pairs)
+
+    def __bool__(self):
+        return bool(self.pairs)
+
+    def __iter__(self):
+        for first_id, count in self.pairs:
+            yield from range(first_id, first_id + count)
+
+    # shorter runs are listed in one `in` predicate, a long or chain costs more in the range optimizer
+    MIN_BETWEEN_COUNT = 3
+
+    @classmethod
+    def _predicate_length(cls, column, first_id, count):
+        if count >= cls.MIN_BETWEEN_COUNT:
+            return len(f'{column} between {first_id} and {first_id + count - 1}') + len(' or ')
+        return sum(len(str(_id)) + len(',') for _id in range(first_id, first_id + count))
+
+    def to_condition(self, column: str = 'id') -> str:
+        """
+        :param column:
+        :return: range predicates eg: id in (1,5,7) or id between 10 and 100
+        """
+        single_ids, predicates = [], []
+        for first_id, count in self.pairs:
+            if count >= self.MIN_BETWEEN_COUNT:
+                predicates.append(f'{column} between {first_id} and {first_id + count - 1}')
+            else:
+                single_ids.extend(range(first_id, first_id + count))
+        if len(single_ids) == 1:
+            predicates.insert(0, f'{column} = {single_ids[0]}')
+        elif single_ids:
+            predicates.insert(0, f"{column} in ({','.join(str(_id) for _id in single_ids)})")
+        return ' or '.join(predicates)
+
+    def chunks(self, column: str = 'id', max_rows: int = None, max_length: int = None):
+        """
+        split into IdRanges whose id count is not more than max_rows and condition is not longer than max_length
+        :param column: the column of condition
+        :param max_rows: None means unlimited
+        :param max_length: None means unlimited
+        :return: IdRanges generator
+        """
+        # the length of `column in () or `
+        in_length = len(f'{column} in () or ')
+        chunk, rows, length = [], 0, in_length
+        for first_id, count in self.pairs:
+            while count > 0:
+                size = count if max_rows is None else min(count, max_rows - rows)
+                predicate_length = self._predicate_length(column, first_id, size)
+                if chunk and (size <= 0 or (max_length is not None and length + predicate_length > max_length)):
+                    yield IdRanges(chunk)
+                    chunk, rows, length = [], 0, in_length
+                    continue
+                chunk.append((first_id, size))
+                rows += size
+                length += predicate_length
+                first_id += size
+                count -= size
+        if chunk:
+            yield IdRanges(chunk)
+
+
 class DeleteType(Enum):
     """
     delete type:
@@ -44,6 +253,8 @@ class ParseSQL(object):
     def __init__(self, sql, base_column):
         self.tokens = parse(sql.strip().strip(";"))[0].tokens
         self._base_column = base_column
+        # the tables history_query reads
+        self.history_tables = set()
 
     def get_stmt_type(self) -> str:
         """
@@ -101,7 +312,20 @@ class ParseSQL(object):
         condition_sql_li: the clause which determine to be deleted rows
         :return:
         """
+        alias_li, column_li, alias_table_mapping, condition_sql_li, placeholders = self.extract_update_plan()
         q_args = deepcopy(args)
+        for value in placeholders:
+            self.delete_args(value, q_args, args_many)
+        return alias_li, column_li, alias_table_mapping, condition_sql_li, q_args
+
+    def extract_update_plan(self) -> (list, set, dict, list, list):
+        """
+        same as extract_update_info, but independent of the arguments
+        :return:
+        alias_li, column_li, alias_table_mapping, condition_sql_li: see extract_update_info
+        placeholders: the placeholders of the assignment list, in order, which are not used by the condition
+        """
+        placeholders = []
         condition_sql_li = [' ', 'from', ' ']
         alias_li, column_li, alias_table_mapping = [], [], None
         set_see, where_see = False, False
@@ -117,14 +341,14 @@ class ParseSQL(object):
             elif set_see and where_see is False and not isinstance(token, Where):
                 assign_value += token.value
             elif set_see and where_see is False and isinstance(token, Where):
-                alias_li, column_li = self.format_update_assignment_list(assign_value, q_args, args_many)
+                alias_li, column_li = self.format_update_assignment_list(assign_value, placeholders)
                 condition_sql_li.append(token.value)
                 where_see = True
             elif where_see:
                 condition_sql_li.append(token.value)
         if where_see is False:
-            alias_li, column_li = self.format_update_assignment_list(assign_value, q_args, args_many)
-        return alias_li, column_li, alias_table_mapping, condition_sql_li, q_args
+            alias_li, column_li = self.format_update_assignment_list(assign_value, placeholders)
+        return alias_li, column_li, alias_table_mapping, condition_sql_li, placeholders
 
     def _get_delete_type(self):
         from_see = False
@@ -216,7 +440,8 @@ class ParseSQL(object):
             alias_table_mapping[alias and alias[0] or table] = table
         return alias_table_mapping
 
-    def delete_args(self, value, q_args, args_many):
+    @staticmethod
+    def delete_args(value, q_args, args_many):
         key = value[2:-2]
         pop_key = key if key else 0
         if args_many:
@@ -225,26 +450,25 @@ class ParseSQL(object):
         else:
             q_args.pop(pop_key)
 
-    def cal_place_hold(self, token_li, q_args, args_many):
+    def cal_place_hold(self, token_li, placeholders):
         for token in token_li:
             if token.ttype == tokens.Name.Placeholder:
-                self.delete_args(token.value, q_args, args_many)
+                placeholders.append(token.value)
             elif hasattr(token, 'tokens'):
-                self.cal_place_hold(token.tokens, q_args, args_many)
+                self.cal_place_hold(token.tokens, placeholders)
 
-    def format_update_assignment_list(self, assignment_list: str, q_args, args_many) -> (list, list):
+    def format_update_assignment_list(self, assignment_list: str, placeholders: list) -> (list, list):
         """
         parsing assignment_list return alias list and column list
         :param assignment_list: the str is mysql's assignment_list
-        :param q_args：
-        :param args_many:
+        :param placeholders: collect the placeholders found in assignment_list
         :return:
         """
         alias_li, column_li = [], set()
         for assignment in assignment_list.split(','):
             table_col, value = assignment.strip().split('=')
             token_li = parse(value)[0].tokens
-            self.cal_place_hold(token_li, q_args, args_many)
+            self.cal_place_hold(token_li, placeholders)
             *table, col = table_col.strip().split('.')
             if table and table[0] not in alias_li:
                 alias_li.append(table[0])
@@ -333,11 +557,14 @@ class ParseSQL(object):
         """
         stmt_token_value = [token.tokens[0].value, '']
         stmt_token_value += self.concat_history_time(table_alias, history_time, True)
+        condition_value = []
         for sub_token in token.tokens[1:]:
             if isinstance(sub_token, Parenthesis):
-                stmt_token_value += self.parse_history_query(sub_token, postfix, history_time)
+                condition_value += self.parse_history_query(sub_token, postfix, history_time)
             else:
-                stmt_token_value.append(self.trans_condition(sub_token))
+                condition_value.append(self.trans_condition(sub_token))
+        # the user's condition is parenthesized, so an OR in it can't bypass the history time predicates
+        stmt_token_value += ['( ', ''.join(condition_value).strip(), ' ) ']
         return stmt_token_value
 
     def trans_condition(self, token):
@@ -362,7 +589,8 @@ class ParseSQL(object):
 
     def concat_history_time(self, table_alias: dict, history_time: str, where_see: bool) -> list:
         """
-        add history query condition
+        add history query condition, the record_end_time predicate lets MySQL prune the partitions of
+        a history table partitioned by record_end_time (see history_partition)
         :param table_alias:
         :param history_time:
         :param where_see:
@@ -436,6 +664,7 @@ class ParseSQL(object):
             stmt_token_value += [' ', 'where ']
             stmt_token_value += self.concat_history_time(table_alias, history_time, False)
         stmt_token_value = self.replace_table(stmt_token_value, table_alias, postfix)
+        self.history_tables.update(table.strip('`') for table in table_alias.values())
         if sub_token:
             stmt_token_value += ['', union_token_value, ' ']
             stmt_token_value += self.parse_history_query(sub_token, postfix, history_time)
@@ -449,3 +678,107 @@ class ParseSQL(object):
         :return: history query
         """
         return ''.join(self.parse_history_query(self.tokens, postfix, history_time))
+
+    def to_plan(self) -> 'HistoryPlan':
+        """
+        extract everything the history operations need from a statement
+        :return: a frozen HistoryPlan
+        """
+        stmt_type = self.get_stmt_type()
+        tables, alias_li, column_li, alias_table_mapping, condition_sql, placeholders = (), (), (), None, '', ()
+        if stmt_type == DMLType.INSERT.value:
+            table_name = self.extract_insert_table()
+            tables = (table_name,) if table_name else ()
+        elif stmt_type == DMLType.DELETE.value:
+            table_li, condition_sql_li, alias_table_mapping = self.extract_delete_info()
+            tables = tuple(table_li or ())
+            condition_sql = ''.join(condition_sql_li or ())
+        elif stmt_type == DMLType.UPDATE.value:
+            alias_li, column_li, alias_table_mapping, condition_sql_li, placeholders = self.extract_update_plan()
+            condition_sql = ''.join(condition_sql_li)
+        return HistoryPlan(stmt_type, tables, MappingProxyType(dict(alias_table_mapping or {})), tuple(alias_li),
+                           frozenset(column_li), condition_sql, tuple(placeholders))
+
+
+class HistoryPlan(namedtuple('HistoryPlan', ['stmt_type', 'tables', 'alias_table_mapping', 'alias_li', 'column_li',
+                                             'condition_sql', 'placeholders'])):
+    """
+    the parsed result of a statement, it's frozen and can be shared between cursors
+        stmt_type: INSERT, UPDATE, DELETE or None
+        tables: the insert table, or the table names in a delete clause
+        alias_table_mapping: a mapping that key is alias and value is real table
+        alias_li: the update aliases
+        column_li: the update columns
+        condition_sql: the clause (start with from) which determine the affected rows
+        placeholders: the placeholders of update assignment list, which must be removed from args
+    """
+    __slots__ = ()
+
+    def strip_args(self, args, args_many):
+        """
+        remove the arguments used by the update assignment list, then left the condition arguments
+        :param args:
+        :param args_many:
+        :return: a copy of args
+        """
+        q_args = deepcopy(args)
+        for value in self.placeholders:
+            ParseSQL.delete_args(value, q_args, args_many)
+        return q_args
+
+
+class PlanCache(object):
+    """
+    thread-safe LRU cache of HistoryPlan keyed by sql text, repeat statements skip sqlparse completely
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: max number of plans to keep
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_plan(self, sql: str, base_column=None, postfix: str = "_history") -> HistoryPlan:
+        """
+        get plan of sql from cache, parse and cache it when not found
+        :param sql:
+        :param base_column:
+        :param postfix:
+        :return:
+        """
+        key = (sql.strip().strip(";"), tuple(base_column or ()), postfix)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return plan
+            self.misses += 1
+        plan = ParseSQL(sql, base_column).to_plan()
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+                self.evictions += 1
+        return plan
+
+    def stats(self) -> dict:
+        """
+        :return: the counters which help to size the cache
+        """
+        with self._lock:
+            return {'size': len(self._plans), 'maxsize': self.maxsize, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+# the default plan cache shared by all connections
+PLAN_CACHE = PlanCache()
@@ -4,13 +4,32 @@
     pymysql connection
 """
 
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from itertools import chain
 from pymysql import err
+from pymysql.constants import CLIENT
 from pymysql.connections import Connection as PyMysqlConnection
 from pymysql.cursors import Cursor as PyMysqlCursor, RE_INSERT_VALUES, DictCursor as PyMysqlDictCursor
+from pymysql.cursors import SSCursor as PyMysqlSSCursor, SSDictCursor as PyMysqlSSDictCursor
 from pymysql._compat import text_type, PY2, range_type
 
-from .parse_common import ParseSQL, DMLType
+from .parse_common import (ParseSQL, DMLType, IdRanges, PkCapture, HistoryMode, PLAN_CACHE,
+                           HISTORY_KEYS_TABLE, CREATE_HISTORY_KEYS_SQL, RE_SINGLE_TABLE_DELETE,
+                           need_history_plan, supports_delete_returning, strip_statement_end,
+                           get_transaction_end)
+from .history_buffer import HistoryBuffer
+from .result_cache import parse_history_time
+from .history_snapshot import (NAMED_SNAPSHOT_SQL, snapshot_postfix, gen_snapshot_sql, gen_drop_snapshot_sql,
+                               gen_snapshot_query, expired_named_snapshots)
+from .batch_common import (Throttle, BatchProgress, CREATE_ARCHIVE_POSITION_SQL, QUERY_ARCHIVE_POSITION_SQL,
+                           SAVE_ARCHIVE_POSITION_SQL, CREATE_BACKFILL_POSITION_SQL, QUERY_BACKFILL_POSITION_SQL,
+                           SAVE_BACKFILL_POSITION_SQL, DELETE_BACKFILL_POSITION_SQL,
+                           READ_COMMITTED_SQL, START_TRANSACTION_SQL, RETRY_WAIT, is_retryable_error)
+from .history_trigger import (SET_HISTORY_SESSION_SQL, UNLOCK_TABLES_SQL, gen_swap_history_trigger_sql,
+                              gen_drop_history_trigger_sql)
+from .table_meta import (TableMeta, TableMetaCache, HISTORY_ADDITIONAL_COLS, TABLE_META_SQL, SCHEMA_META_SQL,
+                         build_table_meta, build_schema_meta, check_history_columns)
 
 
 class Cursor(PyMysqlCursor):
@@ -18,7 +37,7 @@ class Cursor(PyMysqlCursor):
     _defer_warnings = True
 
     def __init__(self, history_posix, history_operate, base_column, record_operate_user, *arg, **kwargs):
-        self.history_additional_cols = ['record_begin_time', 'record_end_time', 'record_operate_user']
+        self.history_additional_cols = list(HISTORY_ADDITIONAL_COLS)
         self.history_operate = history_operate
         self._history_posix = history_posix
         self.base_column = base_column
@@ -29,37 +48,52 @@ class Cursor(PyMysqlCursor):
 
     def _get_history_cursor(self):
         """
-        Create a new cursor to execute queries other than users
+        the internal cursor of the connection executing queries other than users,
+        it's created at the first use and reused by every cursor of the connection
         :return:
         """
-        # return PyMysqlCursor(self.connection)
-        py_cursor = PyMysqlCursor(self.connection)
-        # 关闭历史拉链表操作的warning
-        py_cursor._defer_warnings = True
+        py_cursor = self.connection.history_cursor
+        if py_cursor is None:
+            py_cursor = self.connection.history_cursor = PyMysqlCursor(self.connection)
+            # 关闭历史拉链表操作的warning
+            py_cursor._defer_warnings = True
         return py_cursor
 
+    def _get_table_meta(self, table_name: str) -> TableMeta:
+        """
+        get the metadata of table from the connection's cache, query information_schema when it's missing
+        :param table_name:
+        :return:
+        """
+        schema = self._get_db().db.decode()
+        meta_cache = self.connection.meta_cache
+        meta = meta_cache.get(schema, table_name)
+        if meta is None:
+            cursor = self._get_history_cursor()
+            cursor.execute(TABLE_META_SQL, [schema, table_name, table_name + self._history_posix])
+            rows = cursor.fetchall()
+            meta = build_table_meta(table_name, rows, self._history_posix)
+            if meta is None:
+                # the table doesn't exist, don't cache it
+                return TableMeta(table_name, (), (), frozenset())
+            meta_cache.set(schema, meta)
+        return meta
+
     def _extract_table_column(self, table_name: str) -> list:
         """
         extract the column from table
         :param table_name:
         :return: the column list
         """
-        sql = "select column_name from information_schema.columns where table_name = %s and table_schema = '{}'".format(
-            self._get_db().db.decode())
-        with self._get_history_cursor() as cursor:
-            cursor.execute(sql, [table_name])
-            col_names = cursor.fetchall()
-        return [col_name[0] for col_name in col_names]
+        return list((self._get_table_meta(table_name)).columns)
 
     def _execute_history_dml(self, sql):
         """
         execute dml sql except other than query statement and users
         :param sql:
-        :param args:
-        :return:
+        :return: Number of affected rows
         """
-        with self._get_history_cursor() as cursor:
-            cursor.execute(sql)
+        return self._get_history_cursor().execute(sql)
 
     def _execute_history_query(self, sql, args):
         """
@@ -68,44 +102,59 @@ class Cursor(PyMysqlCursor):
         :param args:
         :return:
         """
-        with self._get_history_cursor() as cursor:
-            cursor.execute(sql, args)
-            ret = cursor.fetchall()
-        return ret
-
-    def _query_record_pk(self, sql, args, args_many, cols):
-        args = args if args_many else [args]
-        ret = []
-        if self.connection.history_cursor_class:
-            col_li = cols.split(',')
-            cursor = self.connection.history_cursor_class(None, False, None, None, self.connection)
-            for arg in args:
-                cursor._origin_execute(sql, arg)
-                ret += [[r.get(col) or r.get('id') for col in col_li] for r in cursor.fetchall()]
-            cursor.close()
-        else:
-            for arg in args:
-                ret += list(self._execute_history_query(sql, arg))
-        return ret
+        cursor = self._get_history_cursor()
+        cursor.execute(sql, args)
+        return cursor.fetchall()
 
-    def _process_insert(self, stream, query, args, args_many=False):
+    def _gen_query_pk_sql(self, sql, args, ordered=True):
+        """
+        generate the union all statements of pk queries of all arguments, split by max_stmt_length,
+        the first column of result is the argument index, which keeps the order of arguments
+        :param sql: pk query starts with 'select '
+        :param args: sequence of arguments
+        :param ordered: whether to order the result by the argument index
+        :return: sql generator
+        """
+        encoding = self._get_db().encoding
+        postfix = ' order by arg_index' if ordered else ''
+        parts, length = [], len(postfix)
+        for index, arg in enumerate(args):
+            part = self.mogrify('(select ' + str(index) + ' as arg_index, ' + sql[len('select '):] + ')', arg)
+            part_length = len(part.encode(encoding)) + len(' union all ')
+            if parts and length + part_length > self.max_stmt_length:
+                yield ' union all '.join(parts) + postfix
+                parts, length = [], len(postfix)
+            parts.append(part)
+            length += part_length
+        if parts:
+            yield ' union all '.join(parts) + postfix
+
+    def _query_record_pk(self, sql, args, args_many):
+        if args_many:
+            # one query for many arguments instead of one query per argument
+            ret = []
+            for query_sql in self._gen_query_pk_sql(sql, args):
+                ret += [row[1:] for row in self._execute_history_query(query_sql, None)]
+            return ret
+        return list(self._execute_history_query(sql, args))
+
+    def _process_insert(self, plan, query, args, args_many=False):
         """
         insert 操作 历史拉链
-        :param stream: 解析sql对象
+        :param plan: sql解析结果
         :param query: sql语句
         :param args: 参数
         :param args_many: 是否批量
         :return:
         """
-        table_name = stream.extract_insert_table()
-        if not table_name:
+        if not plan.tables:
             return None
+        table_name = plan.tables[0]
         ret = self._origin_executemany(query, args) if args_many else self._origin_execute(query, args)
-        if args_many:
-            ids = self._get_insert_ids()
-        else:
-            first_row_id, row_cnt = self.lastrowid, self.rowcount
-            ids = ','.join([str(i) for i in range(first_row_id, first_row_id + row_cnt)])
+        ids = IdRanges(self.pairs) if args_many else IdRanges([(self.lastrowid, self.rowcount)])
+        if self._history_buffered():
+            self.connection.history_buffer.add(table_name, ids, self._record_operate_user)
+            return ret
         col_name = [name for name in self._extract_table_column(table_name) if name not in self.base_column]
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
         self._insert_history_record(table_name, col_name, ids, current_time)
@@ -116,24 +165,7 @@ class Cursor(PyMysqlCursor):
         获取 insert 操作所有的id 值
         :return:
         """
-        ids = list()
-        for lri, ct in self.pairs:
-            for i in range(ct):
-                c = lri + i
-                ids.append(c)
-        return ids
-
-    def _get_insert_ids(self, sep=","):
-        """
-        获取insert操作的id并且将这些id按逗号拼接
-        :return:
-        """
-        ids = list()
-        for lri, ct in self.pairs:
-            for i in range(ct):
-                c = lri + i
-                ids.append(str(c))
-        return "{}".format(sep).join(ids)
+        return list(IdRanges(self.pairs))
 
     def _get_table_from_update_info(self, alias_li, column_li, table_alias_mapping):
         table_cols_mapping = {table: self._extract_table_column(table) for table in table_alias_mapping.values()}
@@ -149,9 +181,26 @@ class Cursor(PyMysqlCursor):
             table_li = [table_alias_mapping.get(alias) for alias in alias_li]
         return table_li, table_cols_mapping
 
-    def _insert_history_record(self, table_name, cols, ids, current_time, delete=False):
-        if not ids:
-            return None
+    def _history_condition_length(self, *sql_parts):
+        """
+        the max length of the id condition in a history statement, so that the statement fits max_stmt_length
+        :param sql_parts: the other parts of statement
+        :return:
+        """
+        encoding = self._get_db().encoding
+        return self.max_stmt_length - sum(len(part.encode(encoding)) for part in sql_parts) - 2
+
+    def _gen_insert_history_sql(self, table_name, cols, ids, current_time, delete=False):
+        """
+        generate the statements copying rows of main table to history table,
+        they are split by max_stmt_length and connection.history_chunk_rows
+        :param table_name: main table
+        :param cols: the columns except base_column
+        :param ids: IdRanges of rows
+        :param current_time:
+        :param delete: whether the rows are being deleted
+        :return: sql generator
+        """
         history_table = table_name + self._history_posix
         base_columns = ['base_' + name for name in self.base_column]
         history_col = ','.join(cols + self.history_additional_cols + base_columns)
@@ -161,60 +210,365 @@ class Cursor(PyMysqlCursor):
         sql = f"""
             insert into {history_table} ({history_col}) 
             select {col}, '{current_time}', '{record_end_time}', '{self._record_operate_user}', 
-            {','.join(self.base_column)} from {main_table} where id in ({ids})
+            {','.join(self.base_column)} from {main_table} where """
+        max_length = self._history_condition_length(sql)
+        for chunk in ids.chunks('id', self.connection.history_chunk_rows, max_length):
+            yield sql + '(' + chunk.to_condition() + ')'
+
+    def _insert_history_record(self, table_name, cols, ids, current_time, delete=False):
+        """
+        copy rows of main table to history table
+        :param table_name: main table
+        :param cols: the columns except base_column
+        :param ids: IdRanges of rows
+        :param current_time:
+        :param delete: whether the rows are being deleted
+        :return: Number of history rows inserted
         """
-        self._execute_history_dml(sql)
+        return self._execute_history_sql(self._gen_insert_history_sql(table_name, cols, ids, current_time, delete))
 
-    def _execute_update(self, stream, query, args, args_many=False):
-        index = 0
-        alias_li, column_li, alias_table_mapping, condition_sql_li, q_args = stream.extract_update_info(args, args_many)
+    def _execute_update(self, plan, query, args, args_many=False):
+        alias_li, column_li, alias_table_mapping = plan.alias_li, plan.column_li, plan.alias_table_mapping
+        q_args = plan.strip_args(args, args_many)
         table_li, table_cols_mapping = self._get_table_from_update_info(alias_li, column_li, alias_table_mapping)
         table_alias_mapping = {table: alias for alias, table in alias_table_mapping.items()}
-        cols = ','.join([table_alias_mapping.get(table) + '.id' for table in table_li])
-        query_pk_sql = "select " + cols + ''.join(condition_sql_li)
-        pks = self._query_record_pk(query_pk_sql, q_args, args_many, cols)
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-        self._end_history_record(table_li, pks, current_time)
-        ret = self._origin_executemany(query, args) if args_many else self._origin_execute(query, args)
-        for table in table_li:
-            table_cols = [name for name in table_cols_mapping.get(table) if name not in self.base_column]
-            ids = [str(pk[index]) for pk in pks]
-            self._insert_history_record(table, table_cols, ','.join(ids), current_time)
-            index += 1
-        return ret
+        pk_alias_li = [table_alias_mapping.get(table) for table in table_li]
+        table_cols_li = [[name for name in table_cols_mapping.get(table) if name not in self.base_column]
+                         for table in table_li]
+        if self.connection.history_pk_capture == PkCapture.TEMP_TABLE.value and not self._history_buffered():
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            pre_sql = chain(self._gen_capture_history_keys_sql(pk_alias_li, plan.condition_sql, q_args, args_many),
+                            self._gen_end_history_sql_by_keys(table_li, current_time))
+            post_sql = chain.from_iterable(
+                self._gen_insert_history_sql_by_keys(table, table_cols, index, current_time)
+                for index, (table, table_cols) in enumerate(zip(table_li, table_cols_li)))
+        else:
+            cols = ','.join([alias + '.id' for alias in pk_alias_li])
+            query_pk_sql = "select " + cols + plan.condition_sql
+            pks = self._query_record_pk(query_pk_sql, q_args, args_many)
+            if self._history_buffered():
+                ret = self._origin_executemany(query, args) if args_many else self._origin_execute(query, args)
+                for index, table in enumerate(table_li):
+                    self.connection.history_buffer.add(table, (pk[index] for pk in pks), self._record_operate_user)
+                return ret
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            pre_sql = self._gen_end_history_sql(table_li, pks, current_time)
+            post_sql = chain.from_iterable(
+                self._gen_insert_history_sql(table, table_cols, IdRanges.from_ids(pk[index] for pk in pks),
+                                             current_time)
+                for index, (table, table_cols) in enumerate(zip(table_li, table_cols_li)))
+        return self._execute_with_history(query, args, args_many, pre_sql, post_sql)
+
+    def _gen_end_history_sql(self, table_li, pks, current_time):
+        """
+        generate the statements closing the current versions in history tables,
+        they are split by max_stmt_length and connection.history_chunk_rows
+        :param table_li: main tables
+        :param pks: primary keys of rows, the nth value of a pk belongs to the nth table
+        :param current_time:
+        :return: sql generator
+        """
+        for index, table_name in enumerate(table_li):
+            yield from self._gen_end_history_sql_by_ids(
+                table_name, IdRanges.from_ids(pk[index] for pk in pks), current_time)
+
+    def _gen_end_history_sql_by_ids(self, table_name, base_ids, current_time):
+        """
+        generate the statements closing the current versions of a history table
+        :param table_name: main table
+        :param base_ids: IdRanges of rows
+        :param current_time:
+        :return: sql generator
+        """
+        sql = f"""
+            update {table_name + self._history_posix} set record_end_time = '{current_time}' 
+            where """
+        sql_postfix = f" and record_end_time = '{self._record_end_time}'"
+        max_length = self._history_condition_length(sql, sql_postfix)
+        for chunk in base_ids.chunks('base_id', self.connection.history_chunk_rows, max_length):
+            yield sql + '(' + chunk.to_condition('base_id') + ')' + sql_postfix
+
+    def _gen_insert_history_sql_by_keys(self, table_name, cols, table_index, current_time, delete=False):
+        """
+        generate the statement copying rows of main table whose keys are captured in HISTORY_KEYS_TABLE
+        :param table_name: main table
+        :param cols: the columns except base_column
+        :param table_index: the table_index of keys in HISTORY_KEYS_TABLE
+        :param current_time:
+        :param delete: whether the rows are being deleted
+        :return: sql generator
+        """
+        history_table = table_name + self._history_posix
+        base_columns = ['base_' + name for name in self.base_column]
+        history_col = ','.join(cols + self.history_additional_cols + base_columns)
+        col = ','.join(['m.' + name for name in cols])
+        base_col = ','.join(['m.' + name for name in self.base_column])
+        record_end_time = current_time if delete else self._record_end_time
+        yield f"""
+            insert into {history_table} ({history_col}) 
+            select {col}, '{current_time}', '{record_end_time}', '{self._record_operate_user}', {base_col} 
+            from {table_name} m join {HISTORY_KEYS_TABLE} k on k.table_index = {table_index} and k.id = m.id
+        """
+
+    def _gen_end_history_sql_by_keys(self, table_li, current_time):
+        """
+        generate the statements closing the current versions whose keys are captured in HISTORY_KEYS_TABLE
+        :param table_li: main tables, the index is the table_index of keys
+        :param current_time:
+        :return: sql generator
+        """
+        for index, table_name in enumerate(table_li):
+            yield f"""
+                update {table_name + self._history_posix} h 
+                join {HISTORY_KEYS_TABLE} k on k.table_index = {index} and k.id = h.base_id 
+                set h.record_end_time = '{current_time}' where h.record_end_time = '{self._record_end_time}'
+            """
+
+    def _execute_history_sql(self, sql_iter):
+        """
+        execute history statements one by one
+        :param sql_iter: sql iterable
+        :return: Number of affected rows of all statements
+        """
+        rows = 0
+        for sql in sql_iter:
+            rows += self._execute_history_dml(sql)
+        return rows
+
+    def _gen_capture_history_keys_sql(self, alias_li, condition_sql, args, args_many):
+        """
+        generate the statements capturing the primary keys of affected rows into the session temporary table
+        HISTORY_KEYS_TABLE, so the keys never leave the server
+        :param alias_li: the tables or aliases whose primary keys are captured, the index is the table_index
+        :param condition_sql: the clause (start with from) which determine the affected rows
+        :param args:
+        :param args_many:
+        :return: sql generator
+        """
+        if not self.connection.history_keys_created:
+            yield CREATE_HISTORY_KEYS_SQL
+            self.connection.history_keys_created = True
+        yield "delete from " + HISTORY_KEYS_TABLE
+        args = args if args_many else [args]
+        for index, alias in enumerate(alias_li):
+            for query_sql in self._gen_query_pk_sql("select " + alias + ".id" + condition_sql, args, False):
+                yield (f"insert ignore into {HISTORY_KEYS_TABLE} (table_index, id) "
+                       f"select {index}, id from ({query_sql}) keys_t")
 
-    def _end_history_record(self, table_li, pks, current_time):
-        index = 0
-        with self._get_history_cursor() as cursor:
-            for table_name in table_li:
-                base_ids = ','.join([str(pk[index]) for pk in pks])
-                if not base_ids:
-                    continue
-                sql = f"""
-                update {table_name + self._history_posix} set record_end_time = '{current_time}' 
-                where base_id in ({base_ids}) and record_end_time = '{self._record_end_time}'
-                """
-                cursor.execute(sql, None)
-                index += 1
-
-    def _execute_delete(self, stream, query, args, args_many=False):
-        index = 0
-        table_name_li, condition_sql, table_alias_mapping = stream.extract_delete_info()
-        cols = ','.join([table + '.id' for table in table_name_li])
-        query_pk_sql = "select " + cols + ''.join(condition_sql)
-        pks = self._query_record_pk(query_pk_sql, args, args_many, cols)
+    def _gen_insert_history_sql_by_rows(self, table_name, cols, rows, current_time, delete=False):
+        """
+        generate the statements inserting the given rows to history table, split by max_stmt_length
+        and connection.history_chunk_rows
+        :param table_name: main table
+        :param cols: the columns except base_column
+        :param rows: the rows of main table, dict of column name and value
+        :param current_time:
+        :param delete: whether the rows are being deleted
+        :return: sql generator
+        """
+        base_columns = ['base_' + name for name in self.base_column]
+        history_col = ','.join(cols + self.history_additional_cols + base_columns)
+        record_end_time = current_time if delete else self._record_end_time
+        sql = f"insert into {table_name}{self._history_posix} ({history_col}) values "
+        place = '(' + ','.join(['%s'] * (len(cols) + len(self.history_additional_cols) + len(base_columns))) + ')'
+        encoding = self._get_db().encoding
+        values, length = [], len(sql.encode(encoding))
+        for row in rows:
+            value = self.mogrify(place, [row[name] for name in cols] +
+                                 [current_time, record_end_time, self._record_operate_user] +
+                                 [row[name] for name in self.base_column])
+            value_length = len(value.encode(encoding)) + 1
+            if values and (length + value_length > self.max_stmt_length or
+                           len(values) >= self.connection.history_chunk_rows):
+                yield sql + ','.join(values)
+                values, length = [], len(sql.encode(encoding))
+            values.append(value)
+            length += value_length
+        if values:
+            yield sql + ','.join(values)
+
+    def _can_delete_returning(self, plan, query):
+        """
+        whether the deleted rows can be returned by DELETE ... RETURNING, only a single-table DELETE on MariaDB
+        :param plan:
+        :param query:
+        :return:
+        """
+        # the buffered versions of the deleted rows must be written before deleting them
+        if self._history_buffered() and self.connection.history_buffer.has_table(plan.tables[0]):
+            return False
+        return (self.connection.history_delete_returning and len(plan.alias_table_mapping) == 1 and
+                plan.tables[0] in plan.alias_table_mapping.values() and
+                RE_SINGLE_TABLE_DELETE.match(query) is not None and 'RETURNING' not in query.upper())
+
+    def _execute_delete_returning(self, plan, query, args, args_many=False):
+        """
+        delete the rows with DELETE ... RETURNING, the history is written from the returned rows,
+        so the primary keys are not queried before deleting
+        :return: Number of affected rows
+        """
+        table_name = plan.tables[0]
+        columns = self._extract_table_column(table_name)
+        # a new line ends the trailing comment of the user's statement
+        sql = strip_statement_end(query) + '\nreturning ' + ','.join(columns)
+        # the statement runs on the history cursor, clear the result of the previous statement of this cursor
+        while self.nextset():
+            pass
+        self._clear_result()
+        rows = []
+        for arg in (args if args_many else [args]):
+            rows += [dict(zip(columns, row)) for row in self._execute_history_query(sql, arg)]
+        self.rowcount, self.lastrowid = len(rows), 0
+        self._executed = sql
+        if not rows:
+            return 0
+        ids = IdRanges.from_ids(row['id'] for row in rows)
+        col_name = [name for name in columns if name not in self.base_column]
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        self._execute_history_sql(chain(
+            self._gen_end_history_sql_by_ids(table_name, ids, current_time),
+            self._gen_insert_history_sql_by_rows(table_name, col_name, rows, current_time, delete=True)))
+        return len(rows)
+
+    def _execute_delete(self, plan, query, args, args_many=False):
+        if self._can_delete_returning(plan, query):
+            return self._execute_delete_returning(plan, query, args, args_many)
+        table_name_li, table_alias_mapping = plan.tables, plan.alias_table_mapping
         table_li = [table_alias_mapping.get(table) for table in table_name_li]
         table_cols_mapping = {table: self._extract_table_column(table) for table in table_alias_mapping.values()}
-        self._end_history_record(table_li, pks, current_time)
-        for table in table_li:
-            table_cols = [name for name in table_cols_mapping.get(table) if name not in self.base_column]
-            ids = [str(pk[index]) for pk in pks]
-            self._insert_history_record(table, table_cols, ','.join(ids), current_time, delete=True)
-            index += 1
+        table_cols_li = [[name for name in table_cols_mapping.get(table) if name not in self.base_column]
+                         for table in table_li]
+        if self.connection.history_pk_capture == PkCapture.TEMP_TABLE.value and not self._history_buffered():
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            pre_sql = chain(
+                self._gen_capture_history_keys_sql(table_name_li, plan.condition_sql, args, args_many),
+                self._gen_end_history_sql_by_keys(table_li, current_time),
+                chain.from_iterable(
+                    self._gen_insert_history_sql_by_keys(table, table_cols, index, current_time, delete=True)
+                    for index, (table, table_cols) in enumerate(zip(table_li, table_cols_li))))
+        else:
+            cols = ','.join([table + '.id' for table in table_name_li])
+            query_pk_sql = "select " + cols + plan.condition_sql
+            pks = self._query_record_pk(query_pk_sql, args, args_many)
+            if self._history_buffered():
+                # the deleted rows get their history at once, write their buffered versions before it
+                for index, table in enumerate(table_li):
+                    self.flush_history_buffer(table, [pk[index] for pk in pks])
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            pre_sql = chain(
+                self._gen_end_history_sql(table_li, pks, current_time),
+                chain.from_iterable(
+                    self._gen_insert_history_sql(table, table_cols, IdRanges.from_ids(pk[index] for pk in pks),
+                                                 current_time, delete=True)
+                    for index, (table, table_cols) in enumerate(zip(table_li, table_cols_li))))
+        return self._execute_with_history(query, args, args_many, pre_sql, ())
+
+    def _history_buffered(self):
+        """
+        whether the history versions are written when the transaction commits rather than at once
+        :return:
+        """
+        return self.connection.history_buffered and not self.connection.get_autocommit()
+
+    def flush_history_buffer(self, table_name=None, ids=None):
+        """
+        write the buffered history versions of current transaction, a row gets one version however many times
+        it was touched, Connection.commit calls it automatically
+        :param table_name: only write the buffered rows of the table among ids, None means all rows
+        :param ids: primary keys
+        :return: Number of history rows inserted
+        """
+        buffer = self.connection.history_buffer
+        items = buffer.items() if table_name is None else buffer.pop(table_name, ids)
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        rows = 0
+        record_operate_user = self._record_operate_user
+        try:
+            for buffered_table, operate_user, buffered_ids in items:
+                self._record_operate_user = operate_user
+                col_name = [name for name in self._extract_table_column(buffered_table)
+                            if name not in self.base_column]
+                self._execute_history_sql(
+                    self._gen_end_history_sql_by_ids(buffered_table, buffered_ids, current_time))
+                rows += self._insert_history_record(buffered_table, col_name, buffered_ids, current_time)
+        finally:
+            self._record_operate_user = record_operate_user
+        if table_name is None:
+            buffer.clear()
+        return rows
+
+    def _execute_with_history(self, query, args, args_many, pre_sql, post_sql):
+        """
+        execute the user's statement between the history statements
+        :param query: the user's statement
+        :param args:
+        :param args_many:
+        :param pre_sql: history statements executed before the user's statement
+        :param post_sql: history statements executed after the user's statement
+        :return: Number of affected rows of the user's statement
+        """
+        if self.connection.history_multi_statements and not args_many:
+            pre_sql_li, post_sql_li, query = list(pre_sql), list(post_sql), self.mogrify(query, args)
+            encoding = self._get_db().encoding
+            sql_length = sum(len(sql.encode(encoding)) + 1 for sql in pre_sql_li + [query] + post_sql_li)
+            if sql_length <= self.max_stmt_length:
+                return self._execute_multi_statements(pre_sql_li, query, post_sql_li)
+            self._execute_history_sql(pre_sql_li)
+            ret = self._origin_execute(query)
+            self._execute_history_sql(post_sql_li)
+            return ret
+        self._execute_history_sql(pre_sql)
         ret = self._origin_executemany(query, args) if args_many else self._origin_execute(query, args)
+        self._execute_history_sql(post_sql)
         return ret
 
+    def _execute_multi_statements(self, pre_sql_li, query, post_sql_li):
+        """
+        send the history statements and the user's statement in one packet, then read back every result,
+        rowcount and lastrowid of the cursor are the user's statement's
+        :param pre_sql_li: history statements before the user's statement
+        :param query: the user's statement whose args have been bound
+        :param post_sql_li: history statements after the user's statement
+        :return: Number of affected rows of the user's statement
+        """
+        while self.nextset():
+            pass
+        # a new line ends the trailing comment of the user's statement
+        self._query(';\n'.join(pre_sql_li + [strip_statement_end(query)] + post_sql_li))
+        for _ in pre_sql_li:
+            self.nextset()
+        rowcount, lastrowid = self.rowcount, self.lastrowid
+        for _ in post_sql_li:
+            self.nextset()
+        self.rowcount, self.lastrowid = rowcount, lastrowid
+        self._executed = query
+        return rowcount
+
+    def _set_history_session(self, history_operate):
+        """
+        pass the operate user and whether to write history to the triggers by session variables,
+        they are sent only when changed since the last statement of the connection
+        :param history_operate: whether the triggers write history table
+        :return:
+        """
+        session = (self._record_operate_user, 0 if history_operate else 1)
+        if self.connection.history_session != session:
+            self._execute_history_dml(self.mogrify(SET_HISTORY_SESSION_SQL, session))
+            self.connection.history_session = session
+
+    def _execute_by_trigger(self, query, args, args_many, history_operate, operate_user):
+        """
+        history_mode is trigger, the triggers write history table, the cursor does no history work
+        :return: Number of affected rows
+        """
+        if operate_user:
+            assert isinstance(operate_user, str), "operate user field must be a string."
+            self._record_operate_user = operate_user
+        if need_history_plan(query):
+            skip = history_operate is False or (self.history_operate is False and not history_operate)
+            self._set_history_session(not skip)
+        return self._origin_executemany(query, args) if args_many else self._origin_execute(query, args)
+
     def execute(self, query, args=None, history_operate=None, operate_user=None):
         """
         Execute a query
@@ -227,6 +581,15 @@ class Cursor(PyMysqlCursor):
         If args is a list or tuple, %s can be used as a placeholder in the query.
         If args is a dict, %(name)s can be used as a placeholder in the query.
         """
+        if self.connection.history_mode == HistoryMode.TRIGGER.value:
+            return self._execute_by_trigger(query, args, False, history_operate, operate_user)
+        if self.connection.history_buffer:
+            # the statement ends current transaction, write or discard the buffered history versions first
+            transaction_end = get_transaction_end(query)
+            if transaction_end == 'COMMIT':
+                self.flush_history_buffer()
+            elif transaction_end == 'ROLLBACK':
+                self.connection.history_buffer.clear()
         if history_operate is False:
             return self._origin_execute(query, args)
         if self.history_operate is False and not history_operate:
@@ -234,14 +597,16 @@ class Cursor(PyMysqlCursor):
         if operate_user:
             assert isinstance(operate_user, str), "operate user field must be a string."
             self._record_operate_user = operate_user
-        stream = ParseSQL(query, self.base_column)
-        query_type = stream.get_stmt_type()
+        if not need_history_plan(query):
+            return self._origin_execute(query, args)
+        plan = self.connection.plan_cache.get_plan(query, self.base_column, self._history_posix)
+        query_type = plan.stmt_type
         if query_type == DMLType.DELETE.value:
-            return self._execute_delete(stream, query, args)
+            return self._execute_delete(plan, query, args)
         elif query_type == DMLType.UPDATE.value:
-            return self._execute_update(stream, query, args)
+            return self._execute_update(plan, query, args)
         elif query_type == DMLType.INSERT.value:
-            return self._process_insert(stream, query, args)
+            return self._process_insert(plan, query, args)
         else:
             return self._origin_execute(query, args)
 
@@ -259,6 +624,8 @@ class Cursor(PyMysqlCursor):
         REPLACE. Otherwise it is equivalent to looping over args with
         execute().
         """
+        if self.connection.history_mode == HistoryMode.TRIGGER.value:
+            return self._execute_by_trigger(query, args, True, history_operate, operate_user)
         if history_operate is False:
             return self._origin_executemany(query, args)
         if self.history_operate is False and not history_operate:
@@ -266,14 +633,16 @@ class Cursor(PyMysqlCursor):
         if operate_user:
             assert isinstance(operate_user, str), "operate user field must be a string."
             self._record_operate_user = operate_user
-        stream = ParseSQL(query, self.base_column)
-        query_type = stream.get_stmt_type()
+        if not need_history_plan(query):
+            return self._origin_executemany(query, args)
+        plan = self.connection.plan_cache.get_plan(query, self.base_column, self._history_posix)
+        query_type = plan.stmt_type
         if query_type == DMLType.DELETE.value:
-            return self._execute_delete(stream, query, args, True)
+            return self._execute_delete(plan, query, args, True)
         elif query_type == DMLType.UPDATE.value:
-            return self._execute_update(stream, query, args, True)
+            return self._execute_update(plan, query, args, True)
         elif query_type == DMLType.INSERT.value:
-            return self._process_insert(stream, query, args, True)
+            return self._process_insert(plan, query, args, True)
         else:
             return self._origin_executemany(query, args)
 
@@ -407,12 +776,98 @@ class Cursor(PyMysqlCursor):
     def execute_history(self, query, args=None, history_time=None):
         """
         Query for a history list of results from history table.
+        The result is reused from connection.history_result_cache when history_time is older than its horizon.
         """
         if self.history_operate is False:
             return self._origin_execute(query, args)
         stream = ParseSQL(query, self.base_column)
         history_query = stream.history_query(history_time, self._history_posix)
-        return self._origin_execute(history_query, args)
+        result_cache = self.connection.history_result_cache
+        if result_cache is None or isinstance(self, SSCursor) or not result_cache.cacheable(history_time):
+            return self._origin_execute(history_query, args)
+        key = result_cache.make_key(history_query, args, history_time, type(self).__name__, self._get_db().db.decode())
+        result = result_cache.get(key)
+        if result is not None:
+            return self._set_cached_result(history_query, *result)
+        ret = self._origin_execute(history_query, args)
+        result_cache.set(key, stream.history_tables, self.description, self._rows)
+        return ret
+
+    def _set_cached_result(self, query, description, rows):
+        """
+        make the cursor look like it has executed the query and fetched the cached rows
+        :return: Number of rows
+        """
+        while self.nextset():
+            pass
+        self._result = None
+        self.description, self._rows, self.rownumber, self.rowcount = description, rows, 0, len(rows)
+        self.lastrowid = None
+        self._executed = query
+        return self.rowcount
+
+    def create_history_snapshot(self, table_names, history_time, temporary=True, ttl=3600):
+        """
+        物化历史快照
+        使用场景：同一历史时刻的多次分析查询，先把这些表在该时刻的数据物化为快照表(主表名+快照后缀)，
+        快照表字段及主键与主表一致，之后通过 execute_snapshot 查询
+        :params table_names: 主表名称列表
+        :params history_time: 历史时刻
+        :params temporary: 是否为会话临时表，否则创建其他连接也能查询的普通表(会隐式提交当前事务)
+        :params ttl: 快照的有效秒数，过期的快照在创建或查询快照时自动删除; None 表示不过期
+        :return: 快照后缀，传给 execute_snapshot
+        """
+        self.drop_history_snapshot()
+        parsed_time = parse_history_time(history_time)
+        if parsed_time is None:
+            raise ValueError("历史时间格式错误: {}".format(history_time))
+        postfix = snapshot_postfix(parsed_time)
+        expire_time = None if ttl is None else datetime.now() + timedelta(seconds=ttl)
+        for table_name in table_names:
+            meta = self._get_table_meta(table_name)
+            if not meta.columns:
+                raise ValueError("表不存在: {}".format(table_name))
+            self._execute_history_sql(gen_snapshot_sql(meta, self.base_column, self._history_posix, postfix,
+                                                       str(history_time), temporary, expire_time))
+        self.connection.history_snapshots[postfix] = (tuple(table_names), expire_time, temporary)
+        return postfix
+
+    def execute_snapshot(self, query, args=None, snapshot=None):
+        """
+        Query the snapshot tables created by create_history_snapshot, the main tables in query are remapped
+        to their snapshot tables.
+        :param query: Query of main tables.
+        :param args: parameters used with query. (optional)
+        :param snapshot: the snapshot postfix create_history_snapshot returns.
+        :return: Number of rows
+        """
+        tables, expire_time, temporary = self.connection.history_snapshots.get(snapshot) or (None, None, True)
+        if tables is not None and expire_time is not None and expire_time <= datetime.now():
+            self.drop_history_snapshot(snapshot)
+            tables = None
+        if tables is None:
+            raise ValueError("历史快照不存在或已过期: {}".format(snapshot))
+        return self._origin_execute(gen_snapshot_query(query, tables, snapshot), args)
+
+    def drop_history_snapshot(self, snapshot=None):
+        """
+        drop a snapshot
+        :param snapshot: the snapshot postfix, None means all expired snapshots, including the named snapshots
+            created by other connections
+        """
+        snapshots = self.connection.history_snapshots
+        if snapshot is not None:
+            tables, _, temporary = snapshots.pop(snapshot, ((), None, True))
+            self._execute_history_sql(gen_drop_snapshot_sql(tables, snapshot, temporary))
+            return
+        now = datetime.now()
+        for postfix, (tables, expire_time, temporary) in list(snapshots.items()):
+            if expire_time is not None and expire_time <= now:
+                del snapshots[postfix]
+                self._execute_history_sql(gen_drop_snapshot_sql(tables, postfix, temporary))
+        rows = self._execute_history_query(NAMED_SNAPSHOT_SQL, [self._get_db().db.decode()])
+        self._execute_history_sql(f"drop table if exists {table_name}"
+                                  for table_name in expired_named_snapshots(rows, now))
 
     def supply_history_data(self, table_name, ids=None, operate_user=None):
         """
@@ -421,6 +876,9 @@ class Cursor(PyMysqlCursor):
         :params table_name: 主表名称
         :params ids: 选填参数 传入ids时，使用传入的id,用于补充指定数据, 未传入时, 补充整表数据
         :params operate_user: 选填参数 历史操作人
+        :return: (补充的id, 已有历史的id)
+        注意: 未传入ids时一次读取整表及历史表的id，在调用方的事务中写入，不会提交; 大表请使用 backfill_history_data 分批补充，
+        每批单独提交并可从检查点继续
         """
         if operate_user:
             assert isinstance(operate_user, str), "operate user field must be a string."
@@ -455,12 +913,343 @@ class Cursor(PyMysqlCursor):
         insert_id_list = list(set(ids) - set(base_id_list))
         if insert_id_list:
             # 待补充的id
-            id_str = ",".join([str(i) for i in insert_id_list])
+            id_ranges = IdRanges.from_ids(insert_id_list)
             col_name = [name for name in self._extract_table_column(table_name) if name not in self.base_column]
             current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-            self._insert_history_record(table_name, col_name, id_str, current_time)
+            self._insert_history_record(table_name, col_name, id_ranges, current_time)
         return insert_id_list, base_id_list
 
+    def backfill_history_data(self, table_name, chunk_size=1000, sleep=0, max_lag=None, lag_checker=None,
+                              progress=None, operate_user=None):
+        """
+        分批补充历史数据
+        使用场景：同 supply_history_data 补充整表数据，按主表id分批在服务端执行 insert ... select ... left join 历史表，
+        只插入历史表中不存在的数据，id不再传回客户端; 每批单独提交，检查点保存在 _history_backfill_position 中，
+        中断后再次调用会从检查点继续，完成后删除检查点
+        :params table_name: 主表名称
+        :params chunk_size: 每批的主表行数
+        :params sleep: 每批之间休眠的秒数
+        :params max_lag: 从库延迟超过该秒数时暂停, 需要同时传入 lag_checker
+        :params lag_checker: 返回从库延迟秒数的函数, eg: batch_common.replica_lag_checker(replica_cursors)
+        :params progress: 每批提交后调用 progress(report)
+        :params operate_user: 选填参数 历史操作人
+        :return: report dict: rows, chunks, seconds, rows_per_second, last_id
+        """
+        if operate_user:
+            assert isinstance(operate_user, str), "operate user field must be a string."
+            self._record_operate_user = operate_user
+        history_table = table_name + self._history_posix
+        col_name = [name for name in self._extract_table_column(table_name) if name not in self.base_column]
+        throttle = Throttle(sleep, max_lag, lag_checker)
+        batch_progress = BatchProgress()
+        self._execute_history_dml(CREATE_BACKFILL_POSITION_SQL)
+        position = self._execute_history_query(QUERY_BACKFILL_POSITION_SQL, [history_table])
+        last_id = position[0][0] if position else 0
+        bound_sql = f"select max(id) from (select id from {table_name} where id > %s order by id limit %s) t"
+        while True:
+            throttle.wait()
+            upper_id = self._execute_history_query(bound_sql, [last_id, chunk_size])[0][0]
+            if upper_id is None:
+                break
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            inserted = self._execute_history_dml(
+                self._gen_backfill_history_sql(table_name, col_name, last_id, upper_id, current_time))
+            last_id = upper_id
+            self._execute_history_dml(self.mogrify(SAVE_BACKFILL_POSITION_SQL, [history_table, last_id]))
+            self.connection.commit()
+            batch_progress.add(inserted, last_id)
+            if progress:
+                progress(batch_progress.report())
+        self._execute_history_dml(self.mogrify(DELETE_BACKFILL_POSITION_SQL, [history_table]))
+        self.connection.commit()
+        return batch_progress.report()
+
+    def backfill_history_range(self, table_name, lower_id, upper_id, chunk_size=1000, limiter=None,
+                               operate_user=None, sleep=0, max_lag=None, lag_checker=None, retries=3):
+        """
+        分批补充主表id在 (lower_id, upper_id] 内的历史数据并校验，用于多个连接并行补充同一张表
+        每批在 read committed 的事务中执行，并行的连接不会在彼此的id范围上加间隙锁; 死锁(1213)或锁等待超时(1205)时
+        回滚该批并重试，已提交的批次不受影响，该范围可以整体再次执行
+        :params table_name: 主表名称
+        :params lower_id: 不包含
+        :params upper_id: 包含
+        :params chunk_size: 每批的主表行数
+        :params limiter: 多个连接共用的 batch_common.RateLimiter
+        :params operate_user: 选填参数 历史操作人
+        :params sleep: 每批之间休眠的秒数
+        :params max_lag: 从库延迟超过该秒数时暂停, 需要同时传入 lag_checker
+        :params lag_checker: 返回从库延迟秒数的函数, eg: batch_common.replica_lag_checker(replica_cursors)
+        :params retries: 每批死锁或锁等待超时后的重试次数
+        :return: report dict: rows, chunks, seconds, rows_per_second, last_id, missing(补充后仍没有历史数据的行数)
+        """
+        if operate_user:
+            assert isinstance(operate_user, str), "operate user field must be a string."
+            self._record_operate_user = operate_user
+        history_table = table_name + self._history_posix
+        col_name = [name for name in self._extract_table_column(table_name) if name not in self.base_column]
+        throttle = Throttle(sleep, max_lag, lag_checker)
+        batch_progress = BatchProgress()
+        last_id = lower_id
+        # every chunk starts its own transaction
+        self.connection.commit()
+        while True:
+            throttle.wait()
+            for attempt in range(retries + 1):
+                try:
+                    inserted, chunk_upper_id = self._backfill_history_chunk(table_name, col_name, last_id,
+                                                                            upper_id, chunk_size)
+                    break
+                except err.MySQLError as e:
+                    self.connection.rollback()
+                    if attempt == retries or not is_retryable_error(e):
+                        raise
+                    time.sleep(RETRY_WAIT * (attempt + 1))
+            if chunk_upper_id is None:
+                break
+            last_id = chunk_upper_id
+            batch_progress.add(inserted, last_id)
+            if limiter is not None:
+                limiter.consume(inserted)
+        verify_sql = f"""
+            select count(*) from {table_name} m left join {history_table} h on h.base_id = m.id
+            where m.id > %s and m.id <= %s and h.base_id is null
+        """
+        missing = (self._execute_history_query(verify_sql, [lower_id, upper_id]))[0][0]
+        return dict(batch_progress.report(), missing=missing)
+
+    def _backfill_history_chunk(self, table_name, col_name, lower_id, upper_id, chunk_size):
+        """
+        backfill the first chunk_size rows of main table whose id is in (lower_id, upper_id] in a read committed
+        transaction and commit it
+        :return: (inserted rows, the last id of the chunk), the last id is None when no row is left
+        """
+        self._execute_history_dml(READ_COMMITTED_SQL)
+        self._execute_history_dml(START_TRANSACTION_SQL)
+        bound_sql = (f"select max(id) from (select id from {table_name} where id > %s and id <= %s "
+                     f"order by id limit %s) t")
+        chunk_upper_id = (self._execute_history_query(bound_sql, [lower_id, upper_id, chunk_size]))[0][0]
+        inserted = 0
+        if chunk_upper_id is not None:
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            inserted = self._execute_history_dml(
+                self._gen_backfill_history_sql(table_name, col_name, lower_id, chunk_upper_id, current_time))
+        self.connection.commit()
+        return inserted, chunk_upper_id
+
+    def _gen_backfill_history_sql(self, table_name, cols, lower_id, upper_id, current_time):
+        """
+        generate the statement copying the rows of main table whose id is in (lower_id, upper_id]
+        and which have no version in history table
+        :param table_name: main table
+        :param cols: the columns except base_column
+        :param lower_id:
+        :param upper_id:
+        :param current_time:
+        :return:
+        """
+        history_table = table_name + self._history_posix
+        base_columns = ['base_' + name for name in self.base_column]
+        history_col = ','.join(cols + self.history_additional_cols + base_columns)
+        col = ','.join(['m.' + name for name in cols])
+        base_col = ','.join(['m.' + name for name in self.base_column])
+        return f"""
+            insert into {history_table} ({history_col})
+            select {col}, '{current_time}', '{self._record_end_time}', '{self._record_operate_user}', {base_col}
+            from {table_name} m left join {history_table} h on h.base_id = m.id
+            where m.id > {lower_id} and m.id <= {upper_id} and h.base_id is null
+        """
+
+    def archive_history_data(self, table_name, before, archive_table=None, chunk_size=1000, sleep=0,
+                             max_lag=None, lag_checker=None, progress=None):
+        """
+        归档历史数据
+        使用场景：把 record_end_time 早于 before 的已结束版本按历史表id分批移动到归档表，未传入归档表时直接删除;
+        每批单独提交，检查点保存在 _history_archive_position 中，中断后再次调用会从检查点继续
+        :params table_name: 主表名称
+        :params before: 截止时间，早于该时间结束的版本会被归档
+        :params archive_table: 选填参数 归档表名称, 不存在时按历史表结构创建; 未传入时只删除
+        :params chunk_size: 每批的行数
+        :params sleep: 每批之间休眠的秒数
+        :params max_lag: 从库延迟超过该秒数时暂停, 需要同时传入 lag_checker
+        :params lag_checker: 返回从库延迟秒数的函数, eg: batch_common.replica_lag_checker(replica_cursors)
+        :params progress: 每批提交后调用 progress(report)
+        :return: report dict: rows, chunks, seconds, rows_per_second, last_id
+        注意: 开始前会提交调用方的连接(connection.commit)，连接上未提交的事务以及缓冲的历史记录(history_buffer)会一并提交，
+        之后每批在单独的事务(start transaction)中执行并提交，请在没有未提交事务的连接上调用
+        """
+        history_table = table_name + self._history_posix
+        before = str(before)
+        self.connection.commit()
+        throttle = Throttle(sleep, max_lag, lag_checker)
+        batch_progress = BatchProgress()
+        self._execute_history_dml(CREATE_ARCHIVE_POSITION_SQL)
+        if archive_table:
+            self._execute_history_dml(f"create table if not exists {archive_table} like {history_table}")
+        position = self._execute_history_query(QUERY_ARCHIVE_POSITION_SQL, [history_table])
+        # a checkpoint of another cutoff is useless, the rows before it may be not archived
+        last_id = position[0][1] if position and position[0][0] == before else 0
+        query_sql = (f"select id from {history_table} where id > %s and record_end_time < %s "
+                     f"order by id limit %s")
+        while True:
+            throttle.wait()
+            rows = self._execute_history_query(query_sql, [last_id, before, chunk_size])
+            if not rows:
+                break
+            condition = IdRanges.from_ids(row[0] for row in rows).to_condition()
+            last_id = rows[-1][0]
+            moved = self._archive_history_chunk(history_table, archive_table, condition, before, last_id)
+            if self.connection.history_result_cache is not None:
+                self.connection.history_result_cache.invalidate(table_name)
+            batch_progress.add(moved, last_id)
+            if progress:
+                progress(batch_progress.report())
+        return batch_progress.report()
+
+    def _archive_history_chunk(self, history_table, archive_table, condition, before, last_id):
+        """
+        copy the ended versions of a chunk to the archive table, delete them and save the checkpoint in one
+        transaction, a failed chunk is rolled back and archived again by the next call
+        :param condition: the history ids of the chunk
+        :param last_id: the checkpoint, the last history id of the chunk
+        :return: Number of history rows deleted
+        """
+        quoted_before = self.mogrify('%s', [before])
+        self._execute_history_dml(START_TRANSACTION_SQL)
+        try:
+            if archive_table:
+                self._execute_history_dml(f"insert into {archive_table} select * from {history_table} "
+                                          f"where ({condition}) and record_end_time < {quoted_before}")
+            moved = self._execute_history_dml(f"delete from {history_table} "
+                                              f"where ({condition}) and record_end_time < {quoted_before}")
+            self._execute_history_dml(self.mogrify(SAVE_ARCHIVE_POSITION_SQL, [history_table, before, last_id]))
+        except err.MySQLError:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+        return moved
+
+    def changes_since(self, table_name, watermark=None, batch_size=1000, safety_lag=0):
+        """
+        stream the history rows of a table written after watermark, ordered by (record_begin_time, id),
+        every version is a change and a version whose record_begin_time equals record_end_time is a delete;
+        the pages are read by an unbuffered cursor with keyset pagination, so the memory is constant,
+        don't execute other statements on the connection until the generator is exhausted or closed
+        :param table_name: main table
+        :param watermark: (record_begin_time, id) of the last consumed change, None means from the beginning
+        :param batch_size: rows of a page
+        :param safety_lag: only the versions older than so many seconds are returned, so a transaction which
+            commits later can't write a version before the watermark
+        :return: (watermark, row) generator, the row is a dict for dict cursors, save the watermark to resume
+        """
+        col_name = [name for name in self._extract_table_column(table_name) if name not in self.base_column]
+        base_columns = ['base_' + name for name in self.base_column]
+        history_col = ','.join(['id'] + col_name + self.history_additional_cols + base_columns)
+        dict_cursor = isinstance(self, (DictCursor, SSDictCursor))
+        begin_index = 1 + len(col_name)
+        while True:
+            upper_time = (datetime.now() - timedelta(seconds=safety_lag)).strftime("%Y-%m-%d %H:%M:%S.%f")
+            if watermark is None:
+                condition, args = '', [upper_time, batch_size]
+            else:
+                condition = ' and (record_begin_time > %s or (record_begin_time = %s and id > %s))'
+                args = [upper_time, watermark[0], watermark[0], watermark[1], batch_size]
+            sql = (f"select {history_col} from {table_name}{self._history_posix} where record_begin_time <= %s"
+                   f"{condition} order by record_begin_time, id limit %s")
+            cursor = (PyMysqlSSDictCursor if dict_cursor else PyMysqlSSCursor)(self.connection)
+            rows = 0
+            try:
+                cursor.execute(sql, args)
+                while True:
+                    row = cursor.fetchone()
+                    if row is None:
+                        break
+                    rows += 1
+                    watermark = (row['record_begin_time'], row['id']) if dict_cursor else (row[begin_index], row[0])
+                    yield watermark, row
+            finally:
+                cursor.close()
+            if rows < batch_size:
+                return watermark
+
+    def diff_between(self, table_name, begin_time, end_time, chunk_size=1000):
+        """
+        compare the rows of a table at two history times, only the records having a version beginning between them
+        are read, so the cost depends on the number of changed records, not the size of history,
+        the records are paged by base_id and compared in sql, the other base columns (eg: a modified time) change
+        between versions, so they are compared like the other columns
+        :param table_name: main table
+        :param begin_time: the earlier history time
+        :param end_time: the later history time
+        :param chunk_size: changed records of a page
+        :return: generator of {"data_type": "insert" | "delete" | "update", "key": {"base_id": value},
+            "original": row at begin_time, "current": row at end_time, "change": {col: {"current", "original"}}}
+        """
+        begin, end = parse_history_time(begin_time), parse_history_time(end_time)
+        if begin is None or end is None:
+            raise ValueError(f"历史时间格式错误: {begin_time}, {end_time}")
+        if begin >= end:
+            raise ValueError("begin_time 必须早于 end_time")
+        col_name = [name for name in self._extract_table_column(table_name) if name not in self.base_column]
+        history_table = table_name + self._history_posix
+        compare_col = col_name + ['base_' + name for name in self.base_column if name != 'id']
+        row_col = ['id'] + compare_col
+        changed_col = ','.join(f"if(a.{name} <=> b.{name}, null, '{name}')" for name in compare_col)
+        select_col = ','.join(['c.base_id'] + [f'a.{name}' for name in row_col] + [f'b.{name}' for name in row_col])
+        # a record has one version at a time when the versions are compared as [record_begin_time, record_end_time)
+        cursor = self._get_history_cursor()
+        last_key = None
+        while True:
+            keyset = ' and base_id > %s' if last_key is not None else ''
+            sql = f"""
+                select {select_col}, concat_ws(',', {changed_col}) from (
+                    select distinct base_id from {history_table}
+                    where record_begin_time > %s and record_begin_time <= %s{keyset} order by base_id limit %s
+                ) c
+                left join {history_table} a on a.base_id = c.base_id
+                    and a.record_begin_time <= %s and a.record_end_time > %s
+                left join {history_table} b on b.base_id = c.base_id
+                    and b.record_begin_time <= %s and b.record_end_time > %s
+                order by c.base_id
+            """
+            args = [begin_time, end_time] + ([last_key] if last_key is not None else []) + [
+                chunk_size, begin_time, begin_time, end_time, end_time]
+            cursor.execute(sql, args)
+            rows = cursor.fetchall()
+            for row in rows:
+                diff = self._diff_row(row, ['base_id'], row_col)
+                if diff is not None:
+                    yield diff
+            if len(rows) < chunk_size:
+                return
+            last_key = rows[-1][0]
+
+    @staticmethod
+    def _diff_row(row, base_columns, row_col):
+        """
+        :param row: base columns, the version at begin time, the version at end time, the changed columns
+        :return: None if the record didn't change
+        """
+        key_len, row_len = len(base_columns), len(row_col)
+        original = dict(zip(row_col, row[key_len:key_len + row_len]))
+        current = dict(zip(row_col, row[key_len + row_len:key_len + 2 * row_len]))
+        changed = row[-1].split(',') if row[-1] else []
+        diff = {"data_type": None, "key": dict(zip(base_columns, row[:key_len])), "original": None, "current": None,
+                "change": {}}
+        if original['id'] is None and current['id'] is None:
+            # inserted and deleted between the two times
+            return None
+        if original['id'] is None:
+            diff.update(data_type="insert", current=current)
+        elif current['id'] is None:
+            diff.update(data_type="delete", original=original)
+        elif changed:
+            diff.update(data_type="update", original=original, current=current,
+                        change={name: {"current": current[name], "original": original[name]} for name in changed})
+        else:
+            # changed and changed back
+            return None
+        return diff
+
     def analysis_process(self, main_table, base_id):
         """
         解析数据变更过程
@@ -468,6 +1257,47 @@ class Cursor(PyMysqlCursor):
         history_data, col_name = self._query_history_data(main_table, base_id)
         if not history_data:
             raise ValueError("回滚数据不存在")
+        return self._analysis_history_data(history_data, col_name)
+
+    def analysis_process_many(self, main_table, base_ids, chunk_size=1000):
+        """
+        解析多条数据的变更过程，每chunk_size个id只查询一次，按 (base_id, record_begin_time, id) 顺序流式读取，
+        内存只与单条数据的版本数有关; 遍历结束前不能在同一连接上执行其他语句
+        :param main_table: 主表名
+        :param base_ids: 主表id
+        :param chunk_size: 每次查询的id个数
+        :return: (base_id, 变更过程) 的生成器，没有历史数据的id不返回
+        """
+        col_name = [name for name in self._extract_table_column(main_table) if name not in self.base_column]
+        history_table = main_table + self._history_posix
+        base_columns = ['base_' + name for name in self.base_column]
+        history_col = ','.join(col_name + self.history_additional_cols + base_columns)
+        base_ids = sorted(set(base_ids))
+        for start in range(0, len(base_ids), chunk_size):
+            chunk = base_ids[start:start + chunk_size]
+            placeholders = ','.join(['%s'] * len(chunk))
+            data_sql = f"SELECT {history_col} FROM {history_table} WHERE base_id in ({placeholders}) " \
+                       f"ORDER BY base_id, record_begin_time, id"
+            cursor = PyMysqlSSDictCursor(self.connection)
+            try:
+                cursor.execute(data_sql, chunk)
+                base_id, history_data = None, []
+                while True:
+                    item = cursor.fetchone()
+                    if item is None or item["base_id"] != base_id:
+                        if history_data:
+                            yield base_id, self._analysis_history_data(history_data, col_name)
+                        if item is None:
+                            break
+                        base_id, history_data = item["base_id"], []
+                    history_data.append(item)
+            finally:
+                cursor.close()
+
+    def _analysis_history_data(self, history_data, col_name):
+        """
+        比对按时间排序的相邻两个版本
+        """
         analysis_result = list()
         for idx, item in enumerate(history_data):
             previous_data = {} if idx == 0 else history_data[idx - 1]
@@ -508,14 +1338,127 @@ class Cursor(PyMysqlCursor):
             data_sql = f"UPDATE {main_table} SET {col_val} WHERE id = %(base_id)s"
         return data_sql, history_data
 
+    def rollback_table_to(self, table_name, history_time, chunk_size=1000, sleep=0, max_lag=None, lag_checker=None,
+                          progress=None, operate_user=None):
+        """
+        把整张表恢复到某一历史时刻
+        使用场景：只处理该时刻之后有新版本的数据，按base_id分批对比主表与该时刻的版本，
+        用 update ... join、insert ... select、delete 恢复，每条恢复的数据记录一个新版本，每批单独提交
+        :params table_name: 主表名称
+        :params history_time: 要恢复到的历史时刻
+        :params chunk_size: 每批对比的数据条数
+        :params sleep: 每批之间休眠的秒数
+        :params max_lag: 从库延迟超过该秒数时暂停, 需要同时传入 lag_checker
+        :params lag_checker: 返回从库延迟秒数的函数, eg: batch_common.replica_lag_checker(replica_cursors)
+        :params progress: 每批提交后调用 progress(report)
+        :params operate_user: 选填参数 历史操作人
+        :return: report dict: rows, chunks, seconds, rows_per_second, last_id, inserted, updated, deleted
+        """
+        restore_time = parse_history_time(history_time)
+        if restore_time is None:
+            raise ValueError(f"历史时间格式错误: {history_time}")
+        if restore_time >= datetime.now():
+            raise ValueError("历史时间必须早于当前时间")
+        if operate_user:
+            assert isinstance(operate_user, str), "operate user field must be a string."
+            self._record_operate_user = operate_user
+        restore_time = restore_time.strftime("%Y-%m-%d %H:%M:%S.%f")
+        col_name = [name for name in self._extract_table_column(table_name) if name not in self.base_column]
+        history_table = table_name + self._history_posix
+        by_trigger = self.connection.history_mode == HistoryMode.TRIGGER.value
+        # the version of a record at restore_time, compared as [record_begin_time, record_end_time)
+        as_of = f"a.record_begin_time <= '{restore_time}' and a.record_end_time > '{restore_time}'"
+        same = ' and '.join(f'm.{name} <=> a.{name}' for name in col_name)
+        query_sql = f"""
+            select k.base_id, m.id, a.id, {same} from (
+                select distinct base_id from {history_table} where record_begin_time > %s and base_id > %s
+                order by base_id limit %s
+            ) k
+            left join {table_name} m on m.id = k.base_id
+            left join {history_table} a on a.base_id = k.base_id and {as_of}
+            order by k.base_id
+        """
+        throttle = Throttle(sleep, max_lag, lag_checker)
+        batch_progress = BatchProgress()
+        counts = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        last_id = 0
+        while True:
+            throttle.wait()
+            rows = self._execute_history_query(query_sql, [restore_time, last_id, chunk_size])
+            if not rows:
+                break
+            insert_ids = IdRanges.from_ids(base_id for base_id, main_id, history_id, _ in rows
+                                           if main_id is None and history_id is not None)
+            update_ids = IdRanges.from_ids(base_id for base_id, main_id, history_id, equal in rows
+                                           if main_id is not None and history_id is not None and not equal)
+            delete_ids = IdRanges.from_ids(base_id for base_id, main_id, history_id, _ in rows
+                                           if main_id is not None and history_id is None)
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            if by_trigger:
+                self._set_history_session(True)
+            if delete_ids:
+                if not by_trigger:
+                    self._execute_history_sql(chain(
+                        self._gen_end_history_sql_by_ids(table_name, delete_ids, current_time),
+                        self._gen_insert_history_sql(table_name, col_name, delete_ids, current_time, delete=True)))
+                self._execute_history_dml(f"delete from {table_name} where ({delete_ids.to_condition()})")
+            if update_ids:
+                if not by_trigger:
+                    self._execute_history_sql(
+                        self._gen_end_history_sql_by_ids(table_name, update_ids, current_time))
+                set_col = ','.join(f'm.{name} = a.{name}' for name in col_name)
+                self._execute_history_dml(f"""
+                    update {table_name} m join {history_table} a on a.base_id = m.id and {as_of}
+                    set {set_col} where ({update_ids.to_condition('m.id')})
+                """)
+            if insert_ids:
+                self._execute_history_dml(f"""
+                    insert into {table_name} (id,{','.join(col_name)})
+                    select a.base_id,{','.join('a.' + name for name in col_name)} from {history_table} a
+                    where ({insert_ids.to_condition('a.base_id')}) and {as_of}
+                """)
+            if not by_trigger:
+                self._execute_history_sql(chain.from_iterable(
+                    self._gen_insert_history_sql(table_name, col_name, ids, current_time)
+                    for ids in (update_ids, insert_ids) if ids))
+            self.connection.commit()
+            if self.connection.history_result_cache is not None:
+                self.connection.history_result_cache.invalidate(table_name)
+            counts['inserted'] += len(insert_ids)
+            counts['updated'] += len(update_ids)
+            counts['deleted'] += len(delete_ids)
+            last_id = rows[-1][0]
+            batch_progress.add(len(insert_ids) + len(update_ids) + len(delete_ids), last_id)
+            if progress:
+                progress(dict(batch_progress.report(), **counts))
+            if len(rows) < chunk_size:
+                break
+        return dict(batch_progress.report(), **counts)
+
+    @staticmethod
+    def _gen_query_history_last_data_sql(history_table, history_col):
+        """
+        :return: sql of _query_history_last_data, the argument is base_id, the last version in the order of
+            _query_history_data, so the (base_id, record_begin_time) index serves it
+        """
+        return (f"SELECT id, {history_col} FROM {history_table} WHERE base_id = %s "
+                f"ORDER BY record_begin_time DESC, id DESC limit 1")
+
     def _query_history_last_data(self, history_table, base_id, history_col):
         """
         获取数据的状态，是否已被删除  query
         """
-        data_sql = f"SELECT id, {history_col} FROM {history_table} WHERE base_id = %s ORDER BY id DESC limit 1"
+        data_sql = self._gen_query_history_last_data_sql(history_table, history_col)
         ret = self.execute(data_sql, [base_id])
         return self.fetchone()
 
+    @staticmethod
+    def _gen_query_history_data_sql(history_table, history_col):
+        """
+        :return: sql of _query_history_data, the argument is base_id
+        """
+        return f"SELECT {history_col} FROM {history_table} WHERE base_id = %s ORDER BY record_begin_time, id"
+
     def _query_history_data(self, main_table, base_id):
         """
         根据主表名查看历史数据
@@ -524,7 +1467,7 @@ class Cursor(PyMysqlCursor):
         history_table = main_table + self._history_posix
         base_columns = ['base_' + name for name in self.base_column]
         history_col = ','.join(col_name + self.history_additional_cols + base_columns)
-        data_sql = f"SELECT {history_col} FROM {history_table} WHERE base_id = %s"
+        data_sql = self._gen_query_history_data_sql(history_table, history_col)
         ret = self.execute(data_sql, [base_id])
         return self.fetchall(), col_name
 
@@ -545,21 +1488,179 @@ class Cursor(PyMysqlCursor):
 
 
 class Connection(PyMysqlConnection):
-    def __init__(self, *arg, postfix='_history', base_column=None, operate_history=False, cursorclass=Cursor, **kwarg):
+    def __init__(self, *arg, postfix='_history', base_column=None, operate_history=False, cursorclass=Cursor,
+                 plan_cache=None, meta_cache=None, preload_history_meta=False,
+                 history_chunk_rows=10000, history_pk_capture=PkCapture.CLIENT.value,
+                 history_multi_statements=False, history_buffered=False, history_mode=HistoryMode.CLIENT.value,
+                 history_result_cache=None, **kwarg):
         """
         :param arg:
         :param postfix: the history table's postfix
         :param operate_history: whether to operate history table
+        :param plan_cache: the PlanCache of parsed statements, default is the shared PLAN_CACHE
+        :param meta_cache: the TableMetaCache of table columns, share it between the connections of a pool
+        :param preload_history_meta: whether to load metadata of all tables which have a history table when connect
+        :param history_chunk_rows: max rows of a history statement
+        :param history_pk_capture: 'client' fetches the affected keys, 'temp_table' keeps them in a session
+            temporary table on the server
+        :param history_multi_statements: whether to send the history statements and the user's statement in one packet
+        :param history_buffered: whether to write the history versions when the transaction commits, a row touched
+            many times in a transaction gets only one version
+        :param history_mode: 'client' writes history tables by the cursor, 'trigger' leaves them to the triggers
+            created by install_history_triggers
+        :param history_result_cache: the HistoryResultCache of execute_history, share it between the connections
+            of a pool, None means no cache
         :param cursorclass:
         :param kwarg:
         """
         self.postfix = postfix
         self.operate_history = operate_history
         self.base_column = base_column
-        self.history_cursor_class = None
+        # the internal cursor executing the history statements, see Cursor._get_history_cursor
+        self.history_cursor = None
+        self.plan_cache = PLAN_CACHE if plan_cache is None else plan_cache
+        self.meta_cache = TableMetaCache() if meta_cache is None else meta_cache
+        self.preload_history_meta = preload_history_meta
+        self.history_chunk_rows = history_chunk_rows
+        self.history_pk_capture = history_pk_capture
+        self.history_multi_statements = history_multi_statements
+        self.history_keys_created = False
+        self.history_buffered = history_buffered
+        self.history_buffer = HistoryBuffer()
+        self.history_mode = history_mode
+        self.history_result_cache = history_result_cache
+        # snapshot postfix -> (main tables, expire time, temporary), see Cursor.create_history_snapshot
+        self.history_snapshots = {}
+        # the (operate user, skip) session variables last sent to the triggers
+        self.history_session = None
+        self.history_delete_returning = False
+        if history_multi_statements:
+            kwarg['client_flag'] = kwarg.get('client_flag', 0) | CLIENT.MULTI_STATEMENTS
         kwarg['cursorclass'] = cursorclass
         super().__init__(*arg, **kwarg)
 
+    def connect(self, sock=None):
+        super().connect(sock)
+        # temporary tables, session variables and the transaction are gone with the old session
+        self.history_keys_created = False
+        self.history_buffer.clear()
+        self.history_session = None
+        self.history_snapshots = {postfix: snapshot for postfix, snapshot in self.history_snapshots.items()
+                                  if not snapshot[2]}
+        self.history_delete_returning = supports_delete_returning(self.get_server_info())
+        if self.preload_history_meta:
+            try:
+                self.preload_table_meta()
+            except Exception:
+                self.close()
+                raise
+
+    def preload_table_meta(self):
+        """
+        load the column metadata of all tables which have a history table with one query,
+        raise ValueError when a history table doesn't match its main table
+        :return: TableMeta list
+        """
+        schema = self.db.decode()
+        if self.meta_cache.is_loaded(schema):
+            return None
+        cursor = PyMysqlCursor(self)
+        try:
+            cursor.execute(SCHEMA_META_SQL, [schema])
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        metas = build_schema_meta(rows, self.postfix)
+        errors = []
+        for meta in metas:
+            missing = check_history_columns(meta, self.base_column)
+            if missing:
+                errors.append("{}{} missing column: {}".format(meta.table_name, self.postfix, ','.join(missing)))
+        if errors:
+            raise ValueError("历史拉链表与主表字段不一致: " + '; '.join(errors))
+        self.meta_cache.set_loaded(schema, metas)
+        return metas
+
+    def install_history_triggers(self, table_names=None):
+        """
+        create the triggers which write history tables, used with history_mode='trigger'
+        :param table_names: main tables, None means all tables which have a history table
+        :return: the main tables whose triggers are created
+        """
+        cursor = PyMysqlCursor(self)
+        try:
+            cursor.execute(SCHEMA_META_SQL, [self.db.decode()])
+            metas = build_schema_meta(cursor.fetchall(), self.postfix)
+            if table_names is not None:
+                metas = [meta for meta in metas if meta.table_name in table_names]
+            for meta in metas:
+                missing = check_history_columns(meta, self.base_column)
+                if missing:
+                    raise ValueError("历史拉链表与主表字段不一致: {}{} missing column: {}".format(
+                        meta.table_name, self.postfix, ','.join(missing)))
+            for meta in metas:
+                try:
+                    for sql in gen_swap_history_trigger_sql(meta, self.base_column, self.postfix):
+                        cursor.execute(sql)
+                finally:
+                    cursor.execute(UNLOCK_TABLES_SQL)
+        finally:
+            cursor.close()
+        return [meta.table_name for meta in metas]
+
+    def drop_history_triggers(self, table_names):
+        """
+        drop the triggers created by install_history_triggers
+        :param table_names: main tables
+        """
+        cursor = PyMysqlCursor(self)
+        try:
+            for table_name in table_names:
+                for sql in gen_drop_history_trigger_sql(table_name, self.postfix):
+                    cursor.execute(sql)
+        finally:
+            cursor.close()
+
+    def flush_history_buffer(self):
+        """
+        write the buffered history versions of current transaction
+        """
+        if self.history_buffer:
+            cursor = self.cursorclass(self.postfix, self.operate_history, self.base_column, None, self)
+            try:
+                cursor.flush_history_buffer()
+            finally:
+                cursor.close()
+
+    def commit(self):
+        """
+        write the buffered history versions then commit
+        """
+        self.flush_history_buffer()
+        super().commit()
+
+    def autocommit(self, value):
+        """
+        enabling autocommit commits current transaction, write the buffered history versions first
+        """
+        if value:
+            self.flush_history_buffer()
+        super().autocommit(value)
+
+    def begin(self):
+        """
+        begin commits current transaction, write the buffered history versions first
+        """
+        self.flush_history_buffer()
+        super().begin()
+
+    def rollback(self):
+        """
+        discard the buffered history versions then roll back
+        """
+        self.history_buffer.clear()
+        super().rollback()
+
     def cursor(self, cursor=None, operate_user=None):
         """
         Create a new cursor to execute queries with.
@@ -569,7 +1670,6 @@ class Connection(PyMysqlConnection):
             None means use Cursor.
         :param operate_user: history table operate user.
         """
-        self.history_cursor_class = cursor
         if operate_user:
             assert isinstance(operate_user, str), "operate user field must be a string."
         if cursor:
@@ -6,9 +6,15 @@
 
 """
 
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from DBUtils.PooledDB import PooledDB
 
 from . import pymysql_connection
+from .table_meta import TableMetaCache
+from .batch_common import (RateLimiter, RangeQueue, split_id_range, summarize_workers, worker_report,
+                           is_retryable_error)
 
 
 class GenConnection(object):
@@ -33,6 +39,7 @@ class GenConnection(object):
             'port': db_conf.get('PORT'),
             'charset': 'utf8',
             'base_column': settings.BASE_COLUMN,
+            'meta_cache': TableMetaCache(),
             'sql_mode': settings.SQL_MODE,
             'connect_timeout': 5,
             'mincached': 1,
@@ -211,16 +218,25 @@ def batch_operate(statement, params, conn, cur, commit=False, history_operate=Tr
     return cur.pairs, cur.rowcount
 
 
-def supply_history_data(table_name, ids=None, operate_user=None):
+def supply_history_data(table_name, ids=None, operate_user=None, chunk_size=1000, sleep=0, progress=None):
     """
     补充历史数据
         使用场景：用于主表已有数据下后续开启历史拉链表时，补充主表已有数据但在历史拉链表里不存在的数据
         :params table_name: 主表名称
-        :params ids: 选填参数 传入ids时，使用传入的id,用于补充指定数据, 未传入时, 补充整表数据
+        :params ids: 选填参数 传入ids时，使用传入的id,用于补充指定数据, 未传入时, 按主表id分批补充整表数据
         :params operate_user: 选填参数 历史操作人
+        :params chunk_size: 补充整表数据时每批的行数
+        :params sleep: 补充整表数据时每批之间休眠的秒数
+        :params progress: 补充整表数据时每批提交后调用 progress(report)
     """
     with GenConnection() as conn:
         with conn.cursor() as cur:
+            if ids is None:
+                report = cur.backfill_history_data(table_name, chunk_size=chunk_size, sleep=sleep, progress=progress,
+                                                   operate_user=operate_user)
+                print("表:{} 插入成功{}条, 共{}批, 耗时{}秒, 每秒{}条".format(table_name, report['rows'], report['chunks'],
+                                                              report['seconds'], report['rows_per_second']))
+                return report
             ins_list, exist_list = cur.supply_history_data(table_name, ids=ids, operate_user=operate_user)
             print("表:{} 插入成功{}条, 成功数据id为{}, 已存在历史表数据{}条, 已存在数据id为{}".format(table_name, len(ins_list),
                                                                             "、".join([str(i) for i in ins_list]),
@@ -228,6 +244,91 @@ def supply_history_data(table_name, ids=None, operate_user=None):
                                                                             "、".join([str(i) for i in exist_list])))
 
 
+def parallel_backfill_history_data(table_name, workers=4, parts=None, chunk_size=1000, rows_per_second=None,
+                                   operate_user=None, sleep=0, max_lag=None, lag_checker=None, max_attempts=3):
+    """
+    多连接并行补充历史数据
+        使用场景：大表开启历史拉链表时，把主表id拆分为多个范围，workers个线程各自从连接池取连接并行补充，并校验每个范围;
+        失败的范围放回队列由其他连接重新执行(已提交的批次会被跳过)，失败 max_attempts 次后记录在 report['failed'] 中，
+        出现死锁或锁等待超时以外的错误时该线程退出
+        :params table_name: 主表名称
+        :params workers: 并行的连接数, 不能超过连接池的 maxconnections
+        :params parts: id范围的个数, 默认 workers * 4
+        :params chunk_size: 每批的主表行数
+        :params rows_per_second: 所有连接合计每秒插入的行数上限, 默认不限制
+        :params operate_user: 选填参数 历史操作人
+        :params sleep: 每个连接每批之间休眠的秒数
+        :params max_lag: 从库延迟超过该秒数时暂停, 需要同时传入 lag_checker
+        :params lag_checker: 返回从库延迟秒数的函数, 会被多个线程同时调用, eg: batch_common.replica_lag_checker
+        :params max_attempts: 每个范围最多执行的次数
+        :return: report dict: rows, seconds, rows_per_second, missing, failed(未完成的id范围),
+            workers(每个连接的行数及每秒行数)
+    """
+    with GenConnection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"select min(id), max(id) from {table_name}")
+            min_id, max_id = cur.fetchone()
+    if min_id is None:
+        return summarize_workers([], 0)
+    id_ranges = RangeQueue(split_id_range(min_id - 1, max_id, parts or workers * 4), max_attempts)
+    limiter = RateLimiter(rows_per_second) if rows_per_second else None
+
+    def work(index):
+        start_time = time.monotonic()
+        rows, ranges, missing, error = 0, 0, 0, None
+        with GenConnection() as conn:
+            with conn.cursor() as cur:
+                while True:
+                    item = id_ranges.get()
+                    if item is None:
+                        break
+                    (lower_id, upper_id), attempts = item
+                    try:
+                        report = cur.backfill_history_range(table_name, lower_id, upper_id, chunk_size=chunk_size,
+                                                            limiter=limiter, operate_user=operate_user, sleep=sleep,
+                                                            max_lag=max_lag, lag_checker=lag_checker)
+                    except Exception as e:
+                        id_ranges.retry((lower_id, upper_id), attempts + 1)
+                        error = repr(e)
+                        if is_retryable_error(e):
+                            continue
+                        # the connection may be broken
+                        break
+                    rows, ranges, missing = rows + report['rows'], ranges + 1, missing + report['missing']
+        return worker_report(index, rows, ranges, missing, time.monotonic() - start_time, error)
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        worker_reports = list(executor.map(work, range(workers)))
+    report = summarize_workers(worker_reports, time.monotonic() - start_time, id_ranges.remaining())
+    print("表:{} 插入成功{}条, 耗时{}秒, 每秒{}条, 仍缺少历史数据{}条, 未完成的范围{}个".format(
+        table_name, report['rows'], report['seconds'], report['rows_per_second'], report['missing'],
+        len(report['failed'])))
+    return report
+
+
+def archive_history_data(table_name, before, archive_table=None, chunk_size=1000, sleep=0, max_lag=None,
+                         lag_checker=None):
+    """
+    归档历史数据
+        使用场景：record_end_time 早于 before 的已结束版本分批移动到归档表，未传入归档表时直接删除，中断后再次调用会继续
+        :params table_name: 主表名称
+        :params before: 截止时间
+        :params archive_table: 选填参数 归档表名称
+        :params chunk_size: 每批的行数
+        :params sleep: 每批之间休眠的秒数
+        :params max_lag: 从库延迟超过该秒数时暂停
+        :params lag_checker: 返回从库延迟秒数的函数
+    """
+    with GenConnection() as conn:
+        with conn.cursor() as cur:
+            report = cur.archive_history_data(table_name, before, archive_table=archive_table, chunk_size=chunk_size,
+                                              sleep=sleep, max_lag=max_lag, lag_checker=lag_checker)
+            print("表:{} 归档{}条, 共{}批, 耗时{}秒, 每秒{}条".format(table_name, report['rows'], report['chunks'],
+                                                         report['seconds'], report['rows_per_second']))
+            return report
+
+
 def rollback_history_data(table_name, history_data_id, operate_user=None):
     """
     回滚历史数据
@@ -249,6 +350,28 @@ def rollback_history_data(table_name, history_data_id, operate_user=None):
         close_db(conn, cursor)
 
 
+def rollback_table_history(table_name, history_time, chunk_size=1000, sleep=0, max_lag=None, lag_checker=None,
+                           operate_user=None):
+    """
+    整表回滚到某一历史时刻
+    :params table_name: 主表名称
+    :params history_time: 要恢复到的历史时刻
+    :params chunk_size: 每批对比的数据条数
+    :params sleep: 每批之间休眠的秒数
+    :params max_lag: 从库延迟超过该秒数时暂停
+    :params lag_checker: 返回从库延迟秒数的函数
+    :params operate_user: 历史记录操作人
+    """
+    with GenConnection() as conn:
+        with conn.cursor() as cur:
+            report = cur.rollback_table_to(table_name, history_time, chunk_size=chunk_size, sleep=sleep,
+                                           max_lag=max_lag, lag_checker=lag_checker, operate_user=operate_user)
+            print("表:{} 恢复到{}, 新增{}条, 更新{}条, 删除{}条, 耗时{}秒, 每秒{}条".format(
+                table_name, history_time, report['inserted'], report['updated'], report['deleted'],
+                report['seconds'], report['rows_per_second']))
+            return report
+
+
 def history_change_process(table_name, data_id):
     """
     获取某条数据的历史变更过程
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    历史时刻查询结果缓存，早于安全时间的历史时刻的结果不会再变化
+
+"""
+
+import pickle
+import shelve
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, date, timedelta
+from collections import OrderedDict
+
+HISTORY_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def parse_history_time(history_time) -> datetime:
+    """
+    :param history_time: datetime, date or string
+    :return: None if it can't be parsed
+    """
+    if isinstance(history_time, datetime):
+        return history_time
+    if isinstance(history_time, date):
+        return datetime(history_time.year, history_time.month, history_time.day)
+    for time_format in HISTORY_TIME_FORMATS:
+        try:
+            return datetime.strptime(str(history_time).strip(), time_format)
+        except ValueError:
+            continue
+    return None
+
+
+class HistoryResultCache(object):
+    """
+    thread-safe LRU cache of execute_history results, the closed versions never change, so the result of
+    a history time older than the horizon can be reused, the results are kept pickled, so the size is bounded
+    and the rows a caller modifies never affect the cache
+    share one instance between the connections of a pool, call invalidate(table) after rewriting history
+    it can't be used with binlog_history.BinlogHistoryBuilder: the consumer writes the versions of a history time
+    after an unbounded replication delay, and the result cached before would never be invalidated
+    """
+
+    def __init__(self, maxsize=256, max_bytes=64 * 1024 * 1024, horizon=300, path=None):
+        """
+        :param maxsize: max number of results to keep in memory
+        :param max_bytes: max bytes of the pickled results in memory
+        :param horizon: only the history time older than so many seconds is cached, the transactions writing
+            history must commit within it
+        :param path: the shelve file backing the cache, None means memory only
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.horizon = horizon
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        # key -> (tables, pickled result)
+        self._results = OrderedDict()
+        # table name -> keys
+        self._table_keys = {}
+        self._lock = threading.Lock()
+        self._shelf = shelve.open(path) if path else None
+
+    def cacheable(self, history_time) -> bool:
+        """
+        :param history_time:
+        :return: whether the history time is older than the horizon
+        """
+        history_time = parse_history_time(history_time)
+        return history_time is not None and history_time < datetime.now() - timedelta(seconds=self.horizon)
+
+    @staticmethod
+    def make_key(sql: str, args, history_time, cursor_type: str = '', schema: str = '') -> str:
+        """
+        :param sql: the rewritten history query
+        :param args:
+        :param history_time:
+        :param cursor_type: the result format differs between cursor types
+        :param schema: the current database of the connection, the unqualified tables of the same sql are different
+            tables in another database
+        :return:
+        """
+        return hashlib.sha1(repr((sql, args, str(history_time), cursor_type, schema)).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        :param key:
+        :return: (description, rows), None if not cached
+        """
+        with self._lock:
+            item = self._results.get(key)
+            if item is not None:
+                self._results.move_to_end(key)
+            elif self._shelf is not None and key in self._shelf:
+                item = self._shelf[key]
+                self._put(key, *item)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(item[1])
+
+    def set(self, key: str, tables, description, rows):
+        """
+        :param key:
+        :param tables: the main tables the query reads
+        :param description: cursor.description
+        :param rows: all rows of result
+        """
+        payload = pickle.dumps((description, rows), pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        tables = frozenset(tables)
+        with self._lock:
+            self._put(key, tables, payload)
+            if self._shelf is not None:
+                self._shelf[key] = (tables, payload)
+
+    async def get_async(self, key: str):
+        """
+        get() for asyncio, the shelve file is read in the default executor so the event loop isn't blocked
+        :param key:
+        :return: (description, rows), None if not cached
+        """
+        if self._shelf is None:
+            return self.get(key)
+        return await asyncio.get_event_loop().run_in_executor(None, self.get, key)
+
+    async def set_async(self, key: str, tables, description, rows):
+        """
+        set() for asyncio, the shelve file is written in the default executor
+        """
+        if self._shelf is None:
+            return self.set(key, tables, description, rows)
+        await asyncio.get_event_loop().run_in_executor(None, self.set, key, tables, description, rows)
+
+    async def invalidate_async(self, table_name: str = None):
+        """
+        invalidate() for asyncio, the shelve file is scanned in the default executor
+        """
+        if self._shelf is None:
+            return self.invalidate(table_name)
+        await asyncio.get_event_loop().run_in_executor(None, self.invalidate, table_name)
+
+    def _put(self, key, tables, payload):
+        if key in self._results:
+            self._remove(key)
+        self._results[key] = (tables, payload)
+        self._size += len(payload)
+        for table in tables:
+            self._table_keys.setdefault(table, set()).add(key)
+        while len(self._results) > self.maxsize or self._size > self.max_bytes:
+            self._remove(next(iter(self._results)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        tables, payload = self._results.pop(key)
+        self._size -= len(payload)
+        for table in tables:
+            keys = self._table_keys.get(table)
+            if keys:
+                keys.discard(key)
+
+    def invalidate(self, table_name: str = None):
+        """
+        drop the results which read the table, call it after archiving or rewriting its history
+        :param table_name: main table, None means all tables
+        """
+        with self._lock:
+            if table_name is None:
+                self._results.clear()
+                self._table_keys.clear()
+                self._size = 0
+                if self._shelf is not None:
+                    self._shelf.clear()
+                return
+            for key in list(self._table_keys.pop(table_name, ())):
+                if key in self._results:
+                    self._remove(key)
+            if self._shelf is not None:
+                for key in [key for key, (tables, _) in self._shelf.items() if table_name in tables]:
+                    del self._shelf[key]
+
+    def stats(self) -> dict:
+        """
+        :return: the counters which help to size the cache
+        """
+        with self._lock:
+            return {'size': len(self._results), 'maxsize': self.maxsize, 'bytes': self._size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def close(self):
+        if self._shelf is not None:
+            self._shelf.close()
+            self._shelf = None
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    表结构缓存，避免每次增删改都查询 information_schema
+
+"""
+
+import time
+import threading
+from collections import namedtuple
+
+HISTORY_ADDITIONAL_COLS = ('record_begin_time', 'record_end_time', 'record_operate_user')
+
+# columns of a main table and its history table in one round trip
+TABLE_META_SQL = """
+    select table_name, column_name, column_key from information_schema.columns
+    where table_schema = %s and table_name in (%s, %s) order by table_name, ordinal_position
+"""
+
+# columns of all tables in a schema
+SCHEMA_META_SQL = """
+    select table_name, column_name, column_key from information_schema.columns
+    where table_schema = %s order by table_name, ordinal_position
+"""
+
+
+class TableMeta(namedtuple('TableMeta', ['table_name', 'columns', 'primary_key', 'history_columns'])):
+    """
+    metadata of a main table
+        columns: the column names in table order
+        primary_key: the primary key column names
+        history_columns: the column names of the history table
+    """
+    __slots__ = ()
+
+
+def build_table_meta(table_name: str, rows, postfix: str) -> TableMeta:
+    """
+    build TableMeta from the rows of TABLE_META_SQL
+    :param table_name:
+    :param rows: (table_name, column_name, column_key) list
+    :param postfix: history table's postfix
+    :return: None if the main table has no column
+    """
+    # table names compare case-insensitively like `table_name in (%s, %s)` under the default collation
+    main_table, history_table = table_name.lower(), (table_name + postfix).lower()
+    columns, primary_key, history_columns = [], [], set()
+    for row_table, column_name, column_key in rows:
+        row_table = row_table.lower()
+        if row_table == main_table:
+            columns.append(column_name)
+            if column_key == 'PRI':
+                primary_key.append(column_name)
+        elif row_table == history_table:
+            history_columns.add(column_name)
+    if not columns:
+        return None
+    return TableMeta(table_name, tuple(columns), tuple(primary_key), frozenset(history_columns))
+
+
+def build_schema_meta(rows, postfix: str) -> list:
+    """
+    build TableMeta of every table which has a history table from the rows of SCHEMA_META_SQL
+    :param rows: (table_name, column_name, column_key) list
+    :param postfix: history table's postfix
+    :return: TableMeta list
+    """
+    table_rows = {}
+    for row in rows:
+        table_rows.setdefault(row[0], []).append(row)
+    metas = []
+    for table_name, main_rows in table_rows.items():
+        history_rows = table_rows.get(table_name + postfix)
+        if history_rows:
+            metas.append(build_table_meta(table_name, main_rows + history_rows, postfix))
+    return metas
+
+
+def check_history_columns(meta: TableMeta, base_column) -> list:
+    """
+    check that the history table has all the columns the history operations write
+    :param meta:
+    :param base_column:
+    :return: the missing column names of history table
+    """
+    base_column = base_column or []
+    expect_columns = [name for name in meta.columns if name not in base_column]
+    expect_columns += list(HISTORY_ADDITIONAL_COLS) + ['base_' + name for name in base_column]
+    return [name for name in expect_columns if name not in meta.history_columns]
+
+
+class TableMetaCache(object):
+    """
+    thread-safe cache of TableMeta with ttl, share one instance between the connections of a pool
+    """
+
+    def __init__(self, ttl=300):
+        """
+        :param ttl: seconds a TableMeta stays valid, None means never expire
+        """
+        self.ttl = ttl
+        self._metas = {}
+        self._lock = threading.Lock()
+
+    def get(self, schema: str, table_name: str) -> TableMeta:
+        """
+        :param schema:
+        :param table_name:
+        :return: None if not cached or expired
+        """
+        key = (schema, table_name)
+        with self._lock:
+            item = self._metas.get(key)
+            if item is None:
+                return None
+            meta, expire_time = item
+            if expire_time is not None and expire_time < time.monotonic():
+                del self._metas[key]
+                return None
+            return meta
+
+    def set(self, schema: str, meta: TableMeta):
+        expire_time = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._metas[(schema, meta.table_name)] = (meta, expire_time)
+
+    def is_loaded(self, schema: str) -> bool:
+        """
+        whether all tables of schema have been preloaded and not expired yet
+        """
+        return self.get(schema, None) is not None
+
+    def set_loaded(self, schema: str, metas: list):
+        """
+        cache the preloaded TableMeta list of a whole schema
+        """
+        for meta in metas:
+            self.set(schema, meta)
+        self.set(schema, TableMeta(None, (), (), frozenset()))
+
+    def invalidate(self, schema: str = None, table_name: str = None):
+        """
+        drop the cached metadata, call it after altering a table
+        :param schema: None means all schemas
+        :param table_name: None means all tables
+        """
+        with self._lock:
+            for key in list(self._metas):
+                if (schema is None or key[0] == schema) and (table_name is None or key[1] == table_name):
+                    del self._metas[key]